@@ -0,0 +1,27 @@
+"""
+Benchmarks for the hot paths of pypct, run on synthetic data.
+
+The synthetic module generates data files and arrays of configurable size 
+(PCTD projection files, DICOM series, slice text files and phantom-like 
+images), and the run module times the library on them. Run from the top 
+of the repository with:
+
+    python -m benchmarks.run -h
+
+================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
@@ -0,0 +1,369 @@
+"""
+Time the hot paths of pypct on synthetic data.
+
+Each benchmark runs in a new Python process, so that its peak memory use 
+can be measured. Results are written as JSON and can be compared against a stored 
+baseline, e.g.:
+
+    python -m benchmarks.run --size small --output baseline.json
+    python -m benchmarks.run --size small --baseline baseline.json
+
+================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import resource
+import tempfile
+import platform
+import traceback
+import subprocess
+
+import numpy as np
+
+import synthetic
+
+# the directory containing the benchmarks package
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sizes = {
+    'small': {'num_events': 200000, 'volume': (128, 128, 16), 'slice': (256, 256), 'num_rois': 100, 'hu_sample': 20000},
+    'medium': {'num_events': 2000000, 'volume': (256, 256, 64), 'slice': (512, 512), 'num_rois': 500, 'hu_sample': 100000},
+    'large': {'num_events': 20000000, 'volume': (512, 512, 128), 'slice': (1024, 1024), 'num_rois': 2000, 'hu_sample': 500000},
+}
+
+# name -> (prepare, setup): prepare(workdir, params) makes the input files 
+# (in the parent process, untimed), and setup(workdir, params) returns the 
+# function to time along with the number of items and bytes it processes
+benchmarks = {}
+
+def benchmark(name, prepare=None):
+    def register(setup):
+        benchmarks[name] = (prepare, setup)
+        return setup
+    return register
+
+def projectionFile(workdir, params):
+    filename = os.path.join(workdir, 'projection.bin')
+    if not os.path.exists(filename):
+        synthetic.makeProjectionFile(filename, params['num_events'])
+    return filename
+
+def dicomDirectory(workdir, params):
+    dirname = os.path.join(workdir, 'dicom')
+    if not os.path.isdir(dirname):
+        synthetic.makeDicomSeries(dirname, params['volume'])
+    return dirname
+
+def sliceFile(workdir, params):
+    filename = os.path.join(workdir, 'slice.txt')
+    if not os.path.exists(filename):
+        synthetic.makeSliceFile(filename, params['slice'])
+    return filename
+
+def makeRegions(params, shape):
+    from pct import roi
+    random = np.random.RandomState(0)
+    regions = []
+    for i in range(params['num_rois']):
+        x, y = random.randint(0, shape[1]), random.randint(0, shape[0])
+        if i % 2:
+            regions.append(roi.CircleROI('c%d' % i, (x, y), random.randint(2, 20), shape))
+        else:
+            regions.append(roi.RectangleROI('r%d' % i, (x, y), tuple(random.randint(2, 40, 2)), shape))
+    return regions
+
+@benchmark('dataconvert.loadData_v0', projectionFile)
+def loadDataBenchmark(workdir, params):
+    from pct import dataconvert
+    filename = projectionFile(workdir, params)
+    def run():
+        with open(filename, 'rb') as f:
+            dataconvert.loadData(f, dataconvert.readVersion(f))
+    return run, params['num_events'], os.path.getsize(filename)
+
+@benchmark('dataconvert.writeOldBinaryFile', projectionFile)
+def writeOldBinaryBenchmark(workdir, params):
+    from pct import dataconvert
+    data = dataconvert.readFile(projectionFile(workdir, params))
+    outputdir = tempfile.mkdtemp(dir=workdir)
+    def run():
+        dataconvert.writeOldBinaryFile(os.path.join(outputdir, 'projection.dat'), data)
+    return run, data.num_events, data.num_events * dataconvert.old_binary_dtype.itemsize
+
+@benchmark('ctload.convertToRSP')
+def convertToRSPBenchmark(workdir, params):
+    from pct import ctload
+    values = np.random.RandomState(0).uniform(-100, 4200, params['hu_sample']).tolist()
+    def run():
+        for value in values:
+            ctload.convertToRSP(value)
+    return run, len(values), 8 * len(values)
+
+@benchmark('ctload.RSPCalibration')
+def calibrationBenchmark(workdir, params):
+    from pct import ctload
+    volume = synthetic.makeVolume(params['volume'])
+    calibration = ctload.RSPCalibration()
+    def run():
+        calibration.convert(volume)
+    return run, volume.size, volume.nbytes
+
+@benchmark('ctload.loadDicomFile', dicomDirectory)
+def loadDicomFileBenchmark(workdir, params):
+    from pct import ctload
+    filenames = sorted(glob.glob(os.path.join(dicomDirectory(workdir, params), '*.dcm')))
+    def run():
+        for filename in filenames:
+            ctload.loadDicomFile(filename)
+    num_pixels = int(np.prod(params['volume']))
+    return run, num_pixels, sum(os.path.getsize(filename) for filename in filenames)
+
+@benchmark('image.Slice._readSliceFile', sliceFile)
+def readSliceBenchmark(workdir, params):
+    from pct import image
+    filename = sliceFile(workdir, params)
+    slice = image.Slice(filename, 0)
+    def run():
+        slice._readSliceFile(filename)
+    return run, slice.pixels.size, os.path.getsize(filename)
+
+@benchmark('roi.makeArrayMask')
+def maskBenchmark(workdir, params):
+    # imported here, so that the import is not timed by makeRegions
+    from pct import roi
+    shape = params['slice']
+    def run():
+        makeRegions(params, shape)
+    return run, params['num_rois'], params['num_rois'] * shape[0] * shape[1]
+
+@benchmark('roi.RotatedRectangleROI')
+def rotatedRectangleBenchmark(workdir, params):
+    from pct import roi
+    shape = params['slice']
+    random = np.random.RandomState(0)
+    specs = [(tuple(random.uniform(0, min(shape), 2)), tuple(random.uniform(2, 40, 2)), random.uniform(0, 180))
+             for i in range(params['num_rois'])]
+    def run():
+        for location, size, angle in specs:
+            roi.RotatedRectangleROI('r', location, size, angle, shape, supersample=4)
+    return run, len(specs), len(specs) * shape[0] * shape[1]
+
+@benchmark('roi.measure')
+def measureBenchmark(workdir, params):
+    pixels, inserts = synthetic.makePhantomImage(params['slice'])
+    regions = makeRegions(params, pixels.shape)
+    def run():
+        for region in regions:
+            region.measure(pixels)
+    return run, len(regions), sum(region.area for region in regions) * pixels.itemsize
+
+@benchmark('roi.getRadialProfile')
+def radialProfileBenchmark(workdir, params):
+    from pct import roi
+    pixels, inserts = synthetic.makePhantomImage(params['slice'])
+    size = max(pixels.shape[0] // 4, 1)
+    regions = [roi.CircleROI('c%d' % i, (x, y), size, pixels.shape) for i, (x, y, r, rsp) in enumerate(inserts)]
+    def run():
+        for region in regions:
+            region.getRadialProfile(pixels)
+    return run, len(regions), sum(region.area for region in regions) * pixels.itemsize
+
+# every timed sample takes at least this long (repeating the benchmark if 
+# needed), so that short benchmarks are not dominated by timer noise
+min_sample_seconds = 0.1
+
+def timeRun(run, repeat):
+    '''
+    Seconds per call of run: the fastest of repeat samples, after one 
+    untimed warm-up call. Returns the seconds and the number of calls in 
+    each sample.
+    '''
+    def sample(loops):
+        start = time.time()
+        for i in xrange(loops):
+            run()
+        return time.time() - start
+    
+    run()
+    loops = 1
+    times = [sample(loops)]
+    while times[-1] < min_sample_seconds:
+        loops *= 2
+        times = [sample(loops)]
+    while len(times) < repeat:
+        times.append(sample(loops))
+    return min(times) / loops, loops
+
+def peakMemory():
+    '''Peak resident memory of this process in MB (ru_maxrss is in kB on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _runBenchmark(name, workdir, params, repeat, result_filename):
+    '''Run one benchmark (in a new process) and write its result as JSON.'''
+    try:
+        from pct import instrument
+        instrument.configure(verbosity=0)
+        prepare, setup = benchmarks[name]
+        run, items, num_bytes = setup(workdir, params)
+        seconds, loops = timeRun(run, repeat)
+        result = {'seconds': seconds,
+                  'loops': loops,
+                  'items': items,
+                  'bytes': num_bytes,
+                  'items_per_second': items / seconds if seconds > 0 else None,
+                  'mb_per_second': num_bytes / 1e6 / seconds if seconds > 0 else None,
+                  'peak_rss_mb': peakMemory()}
+    except Exception:
+        result = {'error': traceback.format_exc()}
+    with open(result_filename, 'w') as f:
+        json.dump(result, f)
+
+def runBenchmarks(names, size='small', workdir=None, repeat=5):
+    '''Run the named benchmarks. Returns a dict of results by name.'''
+    params = sizes[size]
+    remove_workdir = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='pypct-benchmarks-')
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    
+    results = {}
+    try:
+        for name in names:
+            prepare, setup = benchmarks[name]
+            print 'Running %s...' % name
+            sys.stdout.flush()
+            try:
+                if prepare is not None:
+                    prepare(workdir, params)
+            except Exception:
+                results[name] = {'error': traceback.format_exc()}
+                continue
+            # a forked process would start with the peak memory of its 
+            # parent, so each benchmark gets a new interpreter
+            result_filename = os.path.join(workdir, 'result.json')
+            if os.path.exists(result_filename):
+                os.remove(result_filename)
+            command = [sys.executable, '-m', 'benchmarks.run', '--child', name, '--size', size, 
+                       '--workdir', workdir, '--repeat', str(repeat), '--output', result_filename]
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join([root_directory] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+            subprocess.call(command, env=env)
+            if os.path.exists(result_filename):
+                with open(result_filename) as f:
+                    results[name] = json.load(f)
+            else:
+                results[name] = {'error': 'The benchmark process failed'}
+    finally:
+        if remove_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Compare results against baseline results. A benchmark regresses if its 
+    throughput drops, or its peak memory grows, by more than tolerance.
+    Returns a list of (name, message) for the regressions.
+    '''
+    regressions = []
+    for name in sorted(results):
+        current = results[name]
+        previous = baseline.get(name)
+        if previous is None or 'error' in current or 'error' in previous:
+            continue
+        if current['items_per_second'] and previous['items_per_second']:
+            ratio = current['items_per_second'] / previous['items_per_second']
+            if ratio < 1 - tolerance:
+                regressions.append((name, 'throughput is %.0f%% of baseline' % (100 * ratio)))
+        ratio = current['peak_rss_mb'] / previous['peak_rss_mb']
+        if ratio > 1 + tolerance:
+            regressions.append((name, 'peak memory is %.0f%% of baseline' % (100 * ratio)))
+    return regressions
+
+def printResults(results, baseline=None):
+    print '%-30s %10s %14s %10s %10s %8s' % ('Benchmark', 'Time (s)', 'Items/s', 'MB/s', 'Peak MB', 'Speedup')
+    for name in sorted(results):
+        result = results[name]
+        if 'error' in result:
+            print '%-30s failed:' % name
+            print result['error']
+            continue
+        speedup = ''
+        if baseline and name in baseline and baseline[name].get('items_per_second') and result['items_per_second']:
+            speedup = '%.2fx' % (result['items_per_second'] / baseline[name]['items_per_second'])
+        print '%-30s %10.4f %14.0f %10.1f %10.1f %8s' % (name, result['seconds'], result['items_per_second'] or 0, 
+                                                      result['mb_per_second'] or 0, result['peak_rss_mb'], speedup)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time pypct on synthetic data')
+    parser.add_argument('-s', '--size', choices=sorted(sizes), default='small', help='Size of the synthetic data (default is %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of timed samples per benchmark after a warm-up run, the fastest is reported (default is %(default)d)')
+    parser.add_argument('-w', '--workdir', help='Directory for the synthetic data files, kept for later runs (default is a temporary directory)')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='Compare against the results in this JSON file')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help='Allowed relative slowdown or memory growth (default is %(default)g)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('names', nargs='*', help='Benchmarks to run (default is all): %s' % ', '.join(sorted(benchmarks)))
+    args = parser.parse_args()
+    
+    if args.child:
+        _runBenchmark(args.child, args.workdir, sizes[args.size], args.repeat, args.output)
+        sys.exit(0)
+    
+    names = args.names or sorted(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark: %s' % name)
+    
+    results = runBenchmarks(names, args.size, args.workdir, args.repeat)
+    report = {'size': args.size,
+              'parameters': sizes[args.size],
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'results': results}
+    
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('size') != args.size:
+            print 'Warning: baseline was run with size %s' % baseline.get('size')
+        baseline = baseline['results']
+    
+    print
+    printResults(results, baseline)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    
+    failed = any('error' in result for result in results.values())
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, message in regressions:
+            print 'REGRESSION %s: %s' % (name, message)
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
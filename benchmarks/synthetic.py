@@ -0,0 +1,132 @@
+"""
+Generators of synthetic pCT data for benchmarking.
+
+================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+import time
+
+import numpy as np
+
+# u-coordinates (mm) of the four tracker planes
+tracker_planes = (-211.8, -161.6, 161.6, 211.8)
+
+def makePhantomImage(shape=(256, 256), seed=0, noise=0.02):
+    '''
+    A phantom-like slice: a water cylinder (RSP 1) with inserts of air, 
+    polyethylene, a soft tissue and bone equivalent, plus gaussian noise.
+    Returns the pixel array and a list of (x, y, radius, rsp) inserts.
+    '''
+    random = np.random.RandomState(seed)
+    rows, columns = shape
+    y, x = np.ogrid[:rows, :columns]
+    cx, cy = columns / 2.0, rows / 2.0
+    radius = 0.45 * min(rows, columns)
+    pixels = np.where((x - cx)**2 + (y - cy)**2 <= radius**2, 1.0, 0.0)
+    
+    inserts = []
+    for i, rsp in enumerate((0.0, 0.95, 1.05, 1.6)):
+        angle = i * np.pi / 2
+        ix = int(round(cx + 0.5 * radius * np.cos(angle)))
+        iy = int(round(cy + 0.5 * radius * np.sin(angle)))
+        r = max(int(0.12 * radius), 1)
+        pixels[(x - ix)**2 + (y - iy)**2 <= r**2] = rsp
+        inserts.append((ix, iy, r, rsp))
+    
+    pixels += random.normal(0, noise, shape)
+    return pixels, inserts
+
+def makeSliceFile(filename, shape=(256, 256), seed=0):
+    '''Write a phantom slice as a reconstruction text file. Returns the pixels.'''
+    pixels, inserts = makePhantomImage(shape, seed)
+    np.savetxt(filename, pixels, fmt='%.6f')
+    return pixels
+
+def makeVolume(shape=(128, 128, 32), seed=0):
+    '''A stack of phantom slices in CT numbers (0 to 4095), indexed [x][y][z].'''
+    volume = np.empty(shape, dtype=np.uint16)
+    for z in range(shape[2]):
+        pixels, inserts = makePhantomImage(shape[:2], seed + z)
+        volume[:, :, z] = np.clip(pixels * 1000, 0, 4095)
+    return volume
+
+def makeDicomSeries(dirname, shape=(128, 128, 32), seed=0):
+    '''
+    Write a volume from makeVolume as a series of uncompressed DICOM files 
+    with one slice each. Returns the volume.
+    '''
+    import dicom
+    from dicom.dataset import Dataset, FileDataset
+    
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    volume = makeVolume(shape, seed)
+    for z in range(shape[2]):
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        meta.MediaStorageSOPInstanceUID = '1.2.826.0.1.3680043.9.9999.%d' % z
+        meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        meta.ImplementationClassUID = '1.2.826.0.1.3680043.9.9999'
+        image = FileDataset(None, {}, file_meta=meta, preamble='\0' * 128)
+        image.is_little_endian = True
+        image.is_implicit_VR = False
+        image.InstanceNumber = z + 1
+        image.ImagePositionPatient = [0.0, 0.0, 0.625 * z]
+        image.Rows, image.Columns = shape[:2]
+        image.SamplesPerPixel = 1
+        image.PhotometricInterpretation = 'MONOCHROME2'
+        image.BitsAllocated = 16
+        image.BitsStored = 12
+        image.HighBit = 11
+        image.PixelRepresentation = 0
+        image.PixelData = np.ascontiguousarray(volume[:, :, z]).tobytes()
+        image[0x7fe00010].VR = 'OW'
+        image.save_as(os.path.join(dirname, 'slice%04d.dcm' % (z + 1)))
+    return volume
+
+def makeProjectionFile(filename, num_events=100000, angle=0.0, seed=0):
+    '''
+    Write a PCTD version 0 projection file with num_events straight tracks 
+    through the tracker planes and uniformly distributed WEPL.
+    '''
+    random = np.random.RandomState(seed)
+    t_center = random.uniform(-150, 150, num_events)
+    v_center = random.uniform(-40, 40, num_events)
+    t_slope = random.normal(0, 0.01, num_events)
+    v_slope = random.normal(0, 0.01, num_events)
+    
+    columns = []
+    for center, slope in ((t_center, t_slope), (v_center, v_slope)):
+        for u in tracker_planes:
+            columns.append(center + slope * u)
+    for u in tracker_planes:
+        columns.append(np.empty(num_events))
+        columns[-1].fill(u)
+    columns.append(random.uniform(0, 250, num_events))
+    
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('4si', 'PCTD', 0))
+        f.write(struct.pack('i', num_events))
+        f.write(struct.pack('ff', angle, 200.0))
+        now = int(time.time())
+        f.write(struct.pack('ii', now, now))
+        for name in ('synthetic phantom', 'pypct benchmarks', 'pypct'):
+            f.write(struct.pack('i', len(name)) + name)
+        np.array(columns, dtype=np.float32).tofile(f)
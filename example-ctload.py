@@ -35,16 +35,7 @@ voxel_size = (270.0 / 512, 270.0 / 512, 0.625)
 slicenum = 110
 
 start = time.time()
-numpy_file = '{}/voxels{}.npy'.format(inputdir, '-rsp' if convert_to_rsp else '')
-try:
-    print 'Loading voxel array from', numpy_file
-    voxels = np.load(numpy_file, 'r')
-except:
-    print 'Loading DICOM images from', inputdir
-    if convert_to_rsp:
-        print 'This may take a while...'
-    voxels = pct.ctload.processDicomDirectory(inputdir, convert_to_rsp=convert_to_rsp)
-    np.save(numpy_file, voxels)
+voxels = pct.ctload.loadDicomDirectory(inputdir, convert_to_rsp=convert_to_rsp)
 stop = time.time()
 print 'Took {:.4f}s total time'.format(stop - start)
 
@@ -69,15 +60,7 @@ print 'Took {:.4f}s total time'.format(stop - start)
 print 'Creating projection along y-axis'
 start = time.time()
 mask = np.loadtxt(inputdir + '/mask.txt', dtype=bool)
-projection = np.empty((voxels.shape[2], voxels.shape[0]))
-for slicenum in xrange(voxels.shape[2]):
-    slice = voxels[:, :, slicenum]
-    for row in xrange(slice.shape[0]):
-        total = 0.0
-        for col in xrange(slice.shape[1]):
-            if mask[col, row]:
-                total += slice[col, row] * voxel_size[1]
-        projection[slicenum, row] = total
+projection = pct.ctload.projectWEPL(voxels, [0.0], voxel_size, mask, num_detectors=voxels.shape[1])[0]
 stop = time.time()
 print 'Took {:.4f}s total time'.format(stop - start)
 
@@ -65,24 +65,30 @@ regions.append(pct.roi.RectangleROI('poly2', (103, 148), (51, 55), imageshape))
 regions.append(pct.roi.CircleROI('air', (80, 79), 4, imageshape))
 regions.append(pct.roi.CircleROI('bone', (176, 175), 4, imageshape))
 
-images[0].plotSlice(slicenums[0], regions).savefig(os.path.join(currentpath, 'example', 'regions.png'))
+pixels = images[0].getSlice(slicenums[0]).pixels
+
+#Figures are rendered at the end, in parallel
+jobs = []
+jobs.append(('slice', (os.path.join(currentpath, 'example', 'regions.png'), pixels, regions)))
 
 #Display info
+table = pct.roi.measureRegions(regions, images)
 for region in regions:
 	print region.name
 	print '%4s %5s %6s %6s' % ('Iter', 'Slice', 'Mean', 'RMS')
 	for image in images:
-		for slice in image.slices:
-			mean, sigma = region.measure(slice.pixels)
-			print '%4d %5d %6f %6f' % (image.iteration, slice.num, mean, sigma)
+		for row in table[(table['name'] == region.name) & (table['iteration'] == image.iteration)]:
+			print '%4d %5d %6f %6f' % (row['iteration'], row['slice'], row['mean'], row['std'])
 		print
 	
 line = pct.roi.RectangleROI('line', (0, 77), (256, 3), imageshape)
-images[0].plotSlice(slicenums[0], line).savefig(os.path.join(currentpath, 'example', line.name + '.png'))
+jobs.append(('slice', (os.path.join(currentpath, 'example', line.name + '.png'), pixels, line)))
 figname = os.path.join(currentpath, 'example', line.name + '-profile.png')
-line.plotLineProfile(images[0].getSlice(slicenums[0]).pixels, axis=0).savefig(figname)
+jobs.append(('line_profile', (figname, line, pixels), {'axis': 0}))
 
 circle = pct.roi.CircleROI('circle', (80, 79), 15, imageshape)
-images[0].plotSlice(slicenums[0], circle).savefig(os.path.join(currentpath, 'example', circle.name + '.png'))
+jobs.append(('slice', (os.path.join(currentpath, 'example', circle.name + '.png'), pixels, circle)))
 figname = os.path.join(currentpath, 'example', circle.name + '-profile.png')
-circle.plotRadialProfile(images[0].getSlice(slicenums[0]).pixels).savefig(figname)
+jobs.append(('radial_profile', (figname, circle, pixels)))
+
+pct.render.renderBatch(jobs)
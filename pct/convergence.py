@@ -0,0 +1,224 @@
+"""
+Convergence of reconstruction iterations.
+
+An IterationStack holds every iteration of a reconstruction as one
+(iteration, slice, y, x) array, in memory or memory-mapped from a .npy
+file, and computes convergence metrics over it: ROI mean and RMS
+trajectories, norms of the difference between successive iterations,
+per-voxel change maps, and the first iteration at which each metric falls
+below a tolerance.
+
+    stack = IterationStack.fromFiles(nameformat, range(1, 21), slicenums)
+    stack.firstBelow({'relative': 1e-3}, regions)
+
+=================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+import image as pctimage
+import roi as pctroi
+
+# number of bytes of each iteration compared at a time
+block_bytes = 64 * 1024**2
+
+def firstBelow(values, tolerance):
+    '''Index of the first value below tolerance, or None (NaN never is).'''
+    with np.errstate(invalid='ignore'):
+        below = np.flatnonzero(np.asarray(values) < tolerance)
+    return int(below[0]) if len(below) else None
+
+class IterationStack(object):
+    '''
+    Every iteration of a reconstruction as one (iteration, slice, y, x) array.
+    volume: the array (or memmap)
+    iterations: iteration number of each entry (default is 0, 1, ...)
+    slicenums: slice number of each slice (default is 0, 1, ...)
+    
+    The metrics of iteration i compare it with iteration i - 1, so their
+    first entry is NaN.
+    '''
+    
+    def __init__(self, volume, iterations=None, slicenums=None):
+        if volume.ndim != 4:
+            raise ValueError('Expected an (iteration, slice, y, x) array')
+        self.volume = volume
+        self.iterations = list(iterations) if iterations is not None else range(volume.shape[0])
+        self.slicenums = list(slicenums) if slicenums is not None else range(volume.shape[1])
+        if len(self.iterations) != volume.shape[0] or len(self.slicenums) != volume.shape[1]:
+            raise ValueError('Number of iterations or slices does not match the array')
+    
+    @classmethod
+    def fromImages(cls, images, filename=None):
+        '''
+        Stack a list of Images (from pct.image) with the same slices, one per
+        iteration. With filename, the stack is written to that .npy file and
+        memory-mapped instead of held in memory.
+        '''
+        slicenums = [slice.num for slice in images[0].slices]
+        shape = (len(images), len(slicenums)) + tuple(images[0].shape)
+        volume = cls._allocate(shape, filename)
+        for i, image in enumerate(images):
+            if [slice.num for slice in image.slices] != slicenums or tuple(image.shape) != shape[2:]:
+                raise ValueError('Images of all iterations must have the same slices')
+            for s, slice in enumerate(image.slices):
+                volume[i, s] = slice.pixels
+        return cls(volume, [image.iteration for image in images], slicenums)
+    
+    @classmethod
+    def fromFiles(cls, nameformat, iterations, slicenums, filename=None, cache=False):
+        '''
+        Read slice text files named by nameformat.format(iteration=..., slicenum=...)
+        one at a time into the stack (memory-mapped from filename if given),
+        so only the stack itself has to fit in memory.
+        '''
+        shape = None
+        volume = None
+        for i, iteration in enumerate(iterations):
+            for s, slicenum in enumerate(slicenums):
+                pixels = pctimage.Slice(nameformat.format(iteration=iteration, slicenum=slicenum), slicenum, cache).pixels
+                if volume is None:
+                    shape = (len(iterations), len(slicenums)) + pixels.shape
+                    volume = cls._allocate(shape, filename)
+                elif pixels.shape != shape[2:]:
+                    raise Exception('Dimensions of slices do not match!')
+                volume[i, s] = pixels
+        return cls(volume, iterations, slicenums)
+    
+    @classmethod
+    def load(cls, filename, iterations=None, slicenums=None):
+        '''Memory-map a stack saved with save (or fromImages/fromFiles with a filename).'''
+        return cls(np.load(filename, mmap_mode='r'), iterations, slicenums)
+    
+    @staticmethod
+    def _allocate(shape, filename=None):
+        if filename is None:
+            return np.empty(shape)
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=shape)
+    
+    def save(self, filename):
+        np.save(filename, self.volume)
+    
+    def images(self):
+        '''One Image per iteration, as views of the stack.'''
+        return [pctimage.Image.fromVolume(self.volume[i], self.slicenums, iteration)
+                for i, iteration in enumerate(self.iterations)]
+    
+    def _blocks(self):
+        '''Slices of the slice axis, each small enough to compare at once.'''
+        slice_bytes = self.volume[0, 0].size * 8
+        step = max(block_bytes // max(slice_bytes, 1), 1)
+        for start in xrange(0, self.volume.shape[1], step):
+            yield slice(start, start + step)
+    
+    def differenceNorms(self):
+        '''
+        Norms of the difference between each iteration and the previous one:
+        l2 (root of the sum of squares), rms, max (largest absolute change)
+        and relative (l2 divided by the l2 norm of the iteration).
+        Returns a dict of arrays with one entry per iteration.
+        '''
+        num_iterations = self.volume.shape[0]
+        squares, maximums, totals = np.zeros(num_iterations), np.zeros(num_iterations), np.zeros(num_iterations)
+        for block in self._blocks():
+            previous = np.asarray(self.volume[0, block], dtype=float)
+            for i in range(1, num_iterations):
+                current = np.asarray(self.volume[i, block], dtype=float)
+                difference = current - previous
+                squares[i] += np.dot(difference.ravel(), difference.ravel())
+                maximums[i] = max(maximums[i], np.abs(difference).max())
+                totals[i] += np.dot(current.ravel(), current.ravel())
+                previous = current
+        
+        norms = {'l2': np.sqrt(squares),
+                 'rms': np.sqrt(squares / self.volume[0].size),
+                 'max': maximums,
+                 'relative': np.sqrt(squares) / np.where(totals > 0, np.sqrt(totals), np.inf)}
+        for values in norms.values():
+            values[0] = np.nan
+        return norms
+    
+    def changeMap(self, index, relative=False):
+        '''
+        Per-voxel absolute change of iteration index (position in the stack)
+        from the previous one, as a (slice, y, x) array. With relative, the
+        change is divided by the absolute value of the previous iteration
+        (NaN where that is 0).
+        '''
+        if not 1 <= index < self.volume.shape[0]:
+            raise ValueError('Change maps need a previous iteration (index 1 to %d)' % (self.volume.shape[0] - 1))
+        previous = np.asarray(self.volume[index - 1], dtype=float)
+        change = np.abs(self.volume[index] - previous)
+        if relative:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change /= np.where(previous != 0, np.abs(previous), np.nan)
+        return change
+    
+    def maxChangeMap(self, start=1):
+        '''Largest absolute change of each voxel between successive iterations, from index start on.'''
+        result = np.zeros(self.volume.shape[1:])
+        for index in range(max(start, 1), self.volume.shape[0]):
+            np.maximum(result, self.changeMap(index), out=result)
+        return result
+    
+    def roiTrajectories(self, regions):
+        '''
+        Mean and RMS of each region on each slice of each iteration (see
+        pct.roi.measureRegions). Returns (means, sigmas) arrays indexed
+        [region][iteration][slice].
+        '''
+        table = pctroi.measureRegions(regions, self.images())
+        shape = (len(regions), len(self.iterations), len(self.slicenums))
+        return table['mean'].reshape(shape), table['std'].reshape(shape)
+    
+    def metrics(self, regions=None):
+        '''
+        All convergence metrics, as a dict of arrays with one entry per
+        iteration: the difference norms, and for each region the largest
+        change of its mean ('mean <name>') and RMS ('rms <name>') over its
+        slices since the previous iteration.
+        '''
+        metrics = self.differenceNorms()
+        if regions:
+            means, sigmas = self.roiTrajectories(regions)
+            for label, values in (('mean', means), ('rms', sigmas)):
+                changes = np.empty(values.shape[:2])
+                changes[:, 0] = np.nan
+                changes[:, 1:] = np.abs(np.diff(values, axis=1)).max(axis=2)
+                for region, change in zip(regions, changes):
+                    metrics['%s %s' % (label, region.name)] = change
+        return metrics
+    
+    def firstBelow(self, tolerances, regions=None):
+        '''
+        The first iteration (number) at which each metric falls below its
+        tolerance, or None if it never does.
+        tolerances: one tolerance for every metric, or a dict of tolerances
+            by metric name (see metrics)
+        Returns a dict by metric name.
+        '''
+        metrics = self.metrics(regions)
+        if not isinstance(tolerances, dict):
+            tolerances = dict((name, tolerances) for name in metrics)
+        result = {}
+        for name, tolerance in tolerances.items():
+            if name not in metrics:
+                raise ValueError('Unknown metric: %s' % name)
+            index = firstBelow(metrics[name], tolerance)
+            result[name] = self.iterations[index] if index is not None else None
+        return result
@@ -19,10 +19,19 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import glob
+import errno
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.sharedctypes
 
 import dicom
 import numpy as np
 
+import textio
+import instrument
+
 hu_conv = ((0.0, 0.0),
            (800.0, 0.8),
            (900.0, 0.95),
@@ -40,45 +49,380 @@ def convertToRSP(hu_value):
             return rsp
     return 0
 
-def loadDicomFile(filename, convert_to_rsp=True):
+class RSPCalibration(object):
+    '''
+    Piecewise-linear HU to RSP calibration curve.
+    points: sequence of (HU, RSP) pairs in increasing order of HU
+    
+    Values at or below the first HU point, or at or above the last one, 
+    are converted to 0 (the same as convertToRSP). Arrays of any shape are 
+    converted at once; integer arrays (as stored in DICOM files) go through 
+    a look-up table covering the integer HU range of the curve.
     '''
-    Open the named dicom file. Optionally convert to RSP.
+    
+    def __init__(self, points=hu_conv):
+        self.points = tuple((float(hu), float(rsp)) for hu, rsp in points)
+        if len(self.points) < 2:
+            raise ValueError('Calibration curve needs at least two points')
+        self.hu = np.array([p[0] for p in self.points])
+        self.rsp = np.array([p[1] for p in self.points])
+        if np.any(np.diff(self.hu) <= 0):
+            raise ValueError('HU values of calibration curve must be strictly increasing')
+        # same arithmetic as convertToRSP, so the results are identical
+        self.slopes = np.diff(self.rsp) / np.diff(self.hu)
+        
+        self.lut_start = int(np.floor(self.hu[0]))
+        lut_stop = int(np.ceil(self.hu[-1]))
+        self.lut = self._interpolate(np.arange(self.lut_start, lut_stop + 1, dtype=float))
+    
+    @classmethod
+    def fromFile(cls, filename):
+        '''Load a calibration curve from a two column (HU, RSP) text file.'''
+        return cls(np.loadtxt(filename, ndmin=2))
+    
+    def _interpolate(self, hu_values):
+        i = np.searchsorted(self.hu, hu_values, side='right') - 1
+        inside = (i >= 0) & (i < len(self.slopes)) & (hu_values > self.hu[0])
+        i = np.clip(i, 0, len(self.slopes) - 1)
+        rsp = self.slopes[i] * (hu_values - self.hu[i]) + self.rsp[i]
+        return np.where(inside, rsp, 0.0)
+    
+    def convert(self, hu_values):
+        '''
+        Convert an array of HU values to RSP.
+        Returns a new float array with the same shape.
+        '''
+        hu_values = np.asarray(hu_values)
+        if hu_values.dtype.kind in 'iub':
+            # the ends of the table are outside of the curve (i.e. 0), so 
+            # clipping sends every out of range value to 0
+            index = np.clip(hu_values.astype(np.int64) - self.lut_start, 0, len(self.lut) - 1)
+            return self.lut[index]
+        return self._interpolate(np.asarray(hu_values, dtype=float))
+    
+    __call__ = convert
+
+_default_calibration = None
+
+def defaultCalibration():
+    '''Returns the calibration built from the module level hu_conv table.'''
+    global _default_calibration
+    points = tuple((float(hu), float(rsp)) for hu, rsp in hu_conv)
+    if _default_calibration is None or _default_calibration.points != points:
+        _default_calibration = RSPCalibration(points)
+    return _default_calibration
+
+def loadDicomFile(filename, convert_to_rsp=True, calibration=None):
+    '''
+    Open the named dicom file. Optionally convert to RSP, using calibration 
+    (an RSPCalibration) or the default hu_conv curve.
     Returns a numpy array containing pixel values.
     '''    
-    image = dicom.read_file(filename)
-    pixel_array = np.array(image.pixel_array, dtype=float)
-    slice_num = image.InstanceNumber
+    with instrument.stage('read'):
+        image = dicom.read_file(filename)
+        slice_num = image.InstanceNumber
+        hu_values = image.pixel_array
+    instrument.count('bytes_read', os.path.getsize(filename))
     
-    if convert_to_rsp:
-        for i in xrange(pixel_array.shape[0]):
-            for j in xrange(pixel_array.shape[1]):
-                pixel_array[i,j] = convertToRSP(pixel_array[i,j])
+    with instrument.stage('convert'):
+        if convert_to_rsp:
+            if calibration is None:
+                calibration = defaultCalibration()
+            pixel_array = calibration.convert(hu_values)
+        else:
+            pixel_array = np.array(hu_values, dtype=float)
+    instrument.count('pixels', pixel_array.size)
     
     return pixel_array, slice_num
 
-def processDicomDirectory(dirname, extension='.dcm', convert_to_rsp=True):
+def sliceSortKey(header):
+    '''Sort key for the slices of a series: InstanceNumber, then z position.'''
+    instance = getattr(header, 'InstanceNumber', None)
+    position = getattr(header, 'ImagePositionPatient', None)
+    return (int(instance) if instance is not None else 0,
+            float(position[2]) if position is not None else 0.0)
+
+def readDicomHeaders(dirname, extension='.dcm'):
+    '''
+    Read the headers (without pixel data) of all files in dirname with extension.
+    Returns a list of (filename, header) pairs, sorted in slice order.
+    '''
+    headers = []
+    for filename in sorted(os.listdir(dirname)):
+        if filename[-len(extension):] == extension:
+            filename = os.path.join(dirname, filename)
+            headers.append((filename, dicom.read_file(filename, stop_before_pixels=True)))
+    headers.sort(key=lambda item: sliceSortKey(item[1]))
+    return headers
+
+# state shared with the slice loading workers (set by _initSliceLoader)
+_loader = {}
+
+def _initSliceLoader(volume, convert_to_rsp, calibration, processes):
+    _loader['volume'] = volume
+    _loader['convert_to_rsp'] = convert_to_rsp
+    _loader['calibration'] = calibration
+    _loader['processes'] = processes
+
+def _copySlice(job):
+    index, filename = job
+    volume = _loader['volume']
+    pixel_array, slice_num = loadDicomFile(filename, _loader['convert_to_rsp'], _loader['calibration'])
+    if pixel_array.shape != volume.shape[:2]:
+        raise Exception('Dimensions of slice {} do not match the series'.format(slice_num))
+    with instrument.stage('copy'):
+        volume[:, :, index] = pixel_array
+    return slice_num
+
+def _loadSlice(job):
+    '''
+    Load one slice into the volume. Worker processes record their times 
+    and counters separately, and return them as a report for the parent 
+    to merge (threads record directly into the current Recorder).
+    Returns (slice_num, report or None).
+    '''
+    if _loader['processes']:
+        return instrument.recordSeparately(_copySlice, (job,), verbosity=0)
+    return _copySlice(job), None
+
+def processDicomDirectory(dirname, extension='.dcm', convert_to_rsp=True, calibration=None, workers=None, processes=False):
     '''
     Open all files in dirname with extension.
     Returns a 3D array of pixel values. Indices are: [x (horiz)][y (vert)][z (slice)]
+    
+    Slices are ordered by InstanceNumber (then ImagePositionPatient), read 
+    from the headers before any pixel data is decoded. The pixel data is 
+    decoded (and converted) by a pool of workers threads, or processes if 
+    processes is True, directly into one preallocated volume.
     '''
-    filelist = os.listdir(dirname)
-    num = 0
-    for filename in filelist:
-        if filename[-len(extension):] == extension:
-            num += 1
-    print 'Found {} files with extension {}'.format(num, extension)
+    with instrument.stage('header'):
+        headers = readDicomHeaders(dirname, extension)
+    num = len(headers)
+    instrument.log('Found {} files with extension {}'.format(num, extension))
+    if num == 0:
+        raise Exception('No DICOM files found in {}'.format(dirname))
+    
+    if convert_to_rsp and calibration is None:
+        calibration = defaultCalibration()
+    
+    shape = (int(headers[0][1].Rows), int(headers[0][1].Columns), num)
+    if processes:
+        # forked workers write into shared memory, which the result then wraps
+        buffer = multiprocessing.sharedctypes.RawArray('d', shape[0] * shape[1] * shape[2])
+        volume = np.frombuffer(buffer, dtype=float).reshape(shape)
+        pool_class = multiprocessing.Pool
+    else:
+        volume = np.empty(shape, dtype=float)
+        pool_class = multiprocessing.pool.ThreadPool
+    
+    jobs = [(index, filename) for index, (filename, header) in enumerate(headers)]
+    pool = pool_class(workers or multiprocessing.cpu_count(), _initSliceLoader, (volume, convert_to_rsp, calibration, processes))
+    try:
+        for done, (slice_num, report) in enumerate(pool.imap_unordered(_loadSlice, jobs), 1):
+            if report is not None:
+                instrument.current().merge(report)
+            instrument.log('Loaded slice {}'.format(slice_num), 2)
+            instrument.progress('slices', done, num)
+    finally:
+        pool.close()
+        pool.join()
     
-    stack = [0] * num
-    for filename in filelist:
+    return volume
+
+def seriesCacheKey(dirname, extension='.dcm', convert_to_rsp=True, calibration=None):
+    '''
+    Key identifying the converted volume of a series, as '<files>-<conversion>': 
+    a hash of the names, sizes and modification times of its files, and a 
+    hash of the conversion (HU, or the RSP calibration curve).
+    '''
+    files_key = hashlib.sha1()
+    for filename in sorted(os.listdir(dirname)):
         if filename[-len(extension):] == extension:
-            pixel_array, slice_num = loadDicomFile(dirname + '/' + filename, convert_to_rsp)
-            stack[slice_num-1] = pixel_array
-            print 'Loaded slice {}'.format(slice_num)
+            stat = os.stat(os.path.join(dirname, filename))
+            files_key.update('{} {} {!r}\n'.format(filename, stat.st_size, stat.st_mtime))
+    if convert_to_rsp:
+        if calibration is None:
+            calibration = defaultCalibration()
+        conversion_key = hashlib.sha1('RSP {!r}'.format(calibration.points))
+    else:
+        conversion_key = hashlib.sha1('HU')
+    return '{}-{}'.format(files_key.hexdigest(), conversion_key.hexdigest())
+
+def loadDicomDirectory(dirname, extension='.dcm', convert_to_rsp=True, calibration=None, cache_dir=None, workers=None, processes=False):
+    '''
+    Same as processDicomDirectory, but the volume is cached as a .npy file 
+    in cache_dir (by default a .pctcache directory inside dirname).
+    The cache is keyed on the series files and calibration (seriesCacheKey), 
+    so it is rebuilt whenever either changes. Volumes of the same files with 
+    other conversions (HU, other calibrations) are kept next to it. The 
+    default cache directory only belongs to this series, so when a volume 
+    is written there, those of older versions of the files are deleted; a 
+    cache_dir shared by several series has to be cleaned up with pruneCache. 
+    Returns a read-only memmap of the cached volume.
+    '''
+    prune = cache_dir is None
+    if cache_dir is None:
+        cache_dir = os.path.join(dirname, '.pctcache')
+    key = seriesCacheKey(dirname, extension, convert_to_rsp, calibration)
+    cache_filename = os.path.join(cache_dir, 'voxels-{}.npy'.format(key))
+    
+    if os.path.exists(cache_filename):
+        instrument.log('Loading voxel array from {}'.format(cache_filename))
+        return np.load(cache_filename, mmap_mode='r')
+    
+    volume = processDicomDirectory(dirname, extension, convert_to_rsp, calibration, workers, processes)
+    try: 
+        os.makedirs(cache_dir)
+    except OSError as e: 
+        if e.errno != errno.EEXIST:
+            raise
+    # write under a temporary name, so that an interrupted run can never 
+    # leave a partial file behind that looks like a valid cache entry
+    temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+    with instrument.stage('write'):
+        with open(temp_filename, 'wb') as f:
+            np.save(f, volume)
+        os.rename(temp_filename, cache_filename)
+    instrument.count('bytes_written', volume.nbytes)
+    instrument.log('Saved voxel array to {}'.format(cache_filename))
+    if prune:
+        pruneCache(cache_dir, files_key=key.split('-')[0])
+    
+    del volume
+    return np.load(cache_filename, mmap_mode='r')
+
+def pruneCache(cache_dir, files_key=None):
+    '''
+    Delete the cached volumes (voxels-*.npy, see loadDicomDirectory) in 
+    cache_dir, except those of the series files with files_key (the first 
+    part of a seriesCacheKey). Volumes that cannot be deleted (e.g. still 
+    memory-mapped on Windows) are left for a later call.
+    Returns the number of bytes freed.
+    '''
+    freed = 0
+    for filename in glob.glob(os.path.join(cache_dir, 'voxels-*.npy')):
+        key = os.path.basename(filename)[len('voxels-'):-len('.npy')]
+        if files_key is not None and key.split('-')[0] == files_key:
+            continue
+        try:
+            size = os.path.getsize(filename)
+            os.remove(filename)
+        except OSError:
+            continue
+        freed += size
+        instrument.log('Removed superseded voxel array {}'.format(filename), 2)
+    return freed
+
+# state shared with the projection workers (set by _initProjection)
+_projector = {}
+
+def _initProjection(volume, voxel_size, step, num_steps, num_detectors):
+    _projector['volume'] = volume
+    _projector['voxel_size'] = voxel_size
+    _projector['step'] = step
+    _projector['num_steps'] = num_steps
+    _projector['num_detectors'] = num_detectors
+
+def _projectAngle(angle):
+    '''
+    Integrate the (zero padded) volume along parallel rays at one angle, 
+    sampling it with bilinear interpolation in the x-y plane every step mm.
+    Returns a (z, detector) array.
+    '''
+    volume = _projector['volume']
+    dx, dy = _projector['voxel_size'][:2]
+    step = _projector['step']
+    num_steps = _projector['num_steps']
+    num_detectors = _projector['num_detectors']
+    # the volume has one voxel of padding on every side of the x-y plane
+    nx, ny = volume.shape[0] - 2, volume.shape[1] - 2
+    
+    theta = np.radians(angle)
+    direction = np.cos(theta), np.sin(theta)
+    detector = (np.arange(num_detectors) - (num_detectors - 1) / 2.0) * dy
+    offsets = (np.arange(num_steps) - (num_steps - 1) / 2.0) * step
+    # ray origins, as fractional (padded) voxel indices
+    x0 = -detector * direction[1] / dx + (nx - 1) / 2.0 + 1
+    y0 = detector * direction[0] / dy + (ny - 1) / 2.0 + 1
+    
+    total = np.zeros((num_detectors, volume.shape[2]))
+    for offset in offsets:
+        x = x0 + offset * direction[0] / dx
+        y = y0 + offset * direction[1] / dy
+        inside = np.flatnonzero((x > 0) & (x < nx + 1) & (y > 0) & (y < ny + 1))
+        if len(inside) == 0:
+            continue
+        x = x[inside]
+        y = y[inside]
+        i = np.floor(x).astype(int)
+        j = np.floor(y).astype(int)
+        fx = (x - i)[:, np.newaxis]
+        fy = (y - j)[:, np.newaxis]
+        total[inside] += ((1 - fx) * (1 - fy) * volume[i, j] + 
+                          fx * (1 - fy) * volume[i + 1, j] + 
+                          (1 - fx) * fy * volume[i, j + 1] + 
+                          fx * fy * volume[i + 1, j + 1])
+    return total.T * step
+
+def projectWEPL(voxels, angles, voxel_size=(1.0, 1.0, 1.0), mask=None, step=None, num_detectors=None, processes=None):
+    '''
+    Calculate water equivalent path length (WEPL) projections of an RSP 
+    volume, indexed [x][y][z], along parallel rays in the x-y plane.
+    
+    angles: projection angles in degrees (e.g. the projection_angle of each 
+        file of a pCT scan). At 0 the rays run along x, and they rotate 
+        towards y as the angle increases.
+    voxel_size: (x, y, z) voxel dimensions in mm
+    mask: optional boolean array, either [x][y] or [x][y][z]; voxels outside 
+        of it are ignored
+    step: sampling distance along the rays in mm (default is the smaller of 
+        the x and y voxel sizes)
+    num_detectors: number of detector pixels, spaced like the y voxels 
+        (default covers the diagonal of the volume)
+    processes: number of worker processes the angles are spread over 
+        (default is one per CPU)
+    
+    Returns an array of WEPL (mm) indexed [angle][z][detector pixel].
+    '''
+    nx, ny, nz = voxels.shape
+    dx, dy = float(voxel_size[0]), float(voxel_size[1])
+    if step is None:
+        step = min(dx, dy)
+    diagonal = np.hypot(nx * dx, ny * dy)
+    
+    # keep the number of samples odd/even like the number of voxels, so that 
+    # at 0 degrees the samples land on voxel centers
+    num_steps = nx + 2 * int(np.ceil(max(diagonal / step - nx, 0) / 2))
+    if num_detectors is None:
+        num_detectors = ny + 2 * int(np.ceil(max(diagonal / dy - ny, 0) / 2))
+    
+    volume = np.zeros((nx + 2, ny + 2, nz), dtype=np.float32)
+    volume[1:-1, 1:-1] = voxels
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim == 2:
+            mask = mask[:, :, np.newaxis]
+        volume[1:-1, 1:-1] *= mask
+    
+    initargs = (volume, (dx, dy), step, num_steps, num_detectors)
+    angles = list(angles)
+    if processes == 1 or len(angles) == 1:
+        _initProjection(*initargs)
+        projections = [_projectAngle(angle) for angle in angles]
+    else:
+        pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(), _initProjection, initargs)
+        try:
+            projections = pool.map(_projectAngle, angles)
+        finally:
+            pool.close()
+            pool.join()
     
-    return np.dstack(stack)
+    return np.array(projections)
 
-def dumpSlice(pixel_array, filename):
+def dumpSlice(pixel_array, filename, precision=None):
     '''
-    Write the pixel data to a text file.
+    Write the pixel data to a text file. By default values are written like 
+    np.savetxt does ('%.18e'), or with precision decimal places.
     '''
-    np.savetxt(filename, pixel_array)
+    fmt = '%.18e' if precision is None else None
+    textio.writeArray(filename, pixel_array, precision, fmt)
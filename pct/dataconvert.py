@@ -28,210 +28,1097 @@ import glob
 import os, errno
 import time
 import sys
+import zlib
+import traceback
+import multiprocessing
+from itertools import imap
+
+import numpy as np
+
+import textio
+import instrument
+
+# number of float32 columns per event in version 0 files: t[0..3], v[0..3], u[0..3], wepl
+num_columns_v0 = 13
+
+# one event in the old binary format: v[0..3], t[0..3], u-coordinate 
+# look-up table indices, wepl, projection angle and a dummy int for 
+# alignment (48 bytes, native byte order)
+old_binary_dtype = np.dtype([('v', np.float32, (4,)),
+                             ('t', np.float32, (4,)),
+                             ('u', np.uint8, (4,)),
+                             ('wepl', np.float32),
+                             ('angle', np.float32),
+                             ('pad', np.uint32)])
+
+# number of events converted and written at a time
+default_chunk_size = 1 << 18
+
+# Version 1 files start like version 0 files (magic number, version and the 
+# same header), followed by the number of events per chunk. Then come the 
+# chunks: each column of a chunk is stored as float32 values with their 
+# bytes shuffled (all first bytes, then all second bytes, ...) and zlib 
+# compressed, in the order t[0..3], v[0..3], u[0..3], wepl. An index with 
+# one entry per chunk (chunk_index_dtype) follows the chunks, and the file 
+# ends with a trailer giving the index position, the number of chunks and 
+# the magic number 'PCTI'.
+chunk_index_dtype = np.dtype([('num_events', np.int32),
+                              ('wepl_min', np.float32),
+                              ('wepl_max', np.float32),
+                              ('offset', np.int64, (num_columns_v0,)),
+                              ('length', np.int64, (num_columns_v0,))])
+trailer_format = 'qi4s'
 
 class Data(object):
     '''Basic data container.'''
     pass
 
 def readFile(filename):
-    print 'Reading data from file:', filename
+    instrument.log('Reading data from file: %s' % filename)
+    instrument.count('files_read')
     root, ext = os.path.splitext(filename)
     if ext == '.bin':
-        with open(filename, 'rb') as f:
-            magic_number, = struct.unpack('4s', f.read(4))
-            if magic_number != 'PCTD':
-                raise Exception('Unknown data format')
-            
-            version_id, = struct.unpack('i', f.read(4))
-            print 'File contains data in version %d format' % version_id
-            data = loadData(f, version_id)
+        data = mapFile(filename)
     
     elif ext == '.dat':
-        raise Exception('Reading of old binary files is not yet implemented.')
+        data = mapOldBinaryFile(filename)
     
     elif ext == '.txt':
         raise Exception('Reading of old text files is not yet implemented.')
     
     return data
 
+def readVersion(f):
+    '''Check the magic number and return the format version of an open file.'''
+    with instrument.stage('header'):
+        magic_number, = struct.unpack('4s', f.read(4))
+        if magic_number != 'PCTD':
+            raise Exception('Unknown data format')
+        
+        version_id, = struct.unpack('i', f.read(4))
+    instrument.log('File contains data in version %d format' % version_id, 2)
+    return version_id
+
+def mapFile(filename):
+    '''
+    Open a .bin file without reading its event data.
+    The columns are float32 views into a read-only memory map of the file, 
+    so events are only paged in from disk when they are accessed. For 
+    version 1 files they are ChunkedColumns, which only decompress the 
+    chunks that are accessed.
+    '''
+    with open(filename, 'rb') as f:
+        version_id = readVersion(f)
+        if version_id == 1:
+            data = readHeader_v0(f)
+            readChunkIndex(f, data)
+            data.filename = filename
+            chunked_file = ChunkedFile(filename, data.chunk_size, data.chunk_index)
+            setColumns(data, [ChunkedColumn(chunked_file, i) for i in range(num_columns_v0)])
+            printFirstEvent(data)
+            return data
+        elif version_id != 0:
+            raise Exception('Unknown data format version')
+        data = readHeader_v0(f)
+        offset = f.tell()
+    
+    shape = (num_columns_v0, data.num_events)
+    if data.num_events > 0:
+        columns = np.memmap(filename, dtype=np.float32, mode='r', offset=offset, shape=shape)
+    else:
+        columns = np.zeros(shape, dtype=np.float32)
+    setColumns(data, columns)
+    printFirstEvent(data)
+    return data
+
 def loadData(f, version_id):
     if version_id == 0:
         return loadData_v0(f)
+    elif version_id == 1:
+        return loadData_v1(f)
     else:
         raise Exception('Unknown data format version')
 
-def loadData_v0(f):
+def readHeader_v0(f):
+    with instrument.stage('header'):
+        data = _readHeader_v0(f)
+    
+    instrument.log('Found %d events' % data.num_events, 2)
+    instrument.log('Projection angle: %s' % data.projection_angle, 2)
+    instrument.log('Beam energy: %s' % data.beam_energy, 2)
+    instrument.log('Generation date: %s' % time.strftime('%Y-%m-%d', data.generation_date), 2)
+    instrument.log('Preprocess date: %s' % time.strftime('%Y-%m-%d', data.preprocess_date), 2)
+    instrument.log('Phantom name: %s' % data.phantom_name, 2)
+    instrument.log('Data source: %s' % data.data_source, 2)
+    instrument.log('Prepared by: %s' % data.prepared_by, 2)
+    return data
+
+def _readHeader_v0(f):
     data = Data()
     
     data.num_events, = struct.unpack('i', f.read(4))
-    print 'Found %d events' % data.num_events
-    
     data.projection_angle, data.beam_energy = struct.unpack('ff', f.read(8))
-    print 'Projection angle:', data.projection_angle
-    print 'Beam energy:', data.beam_energy
     
     data.generation_date, data.preprocess_date = struct.unpack('ii', f.read(8))
     data.generation_date = time.localtime(data.generation_date)
     data.preprocess_date = time.localtime(data.preprocess_date)
-    print 'Generation date:', time.strftime('%Y-%m-%d', data.generation_date)
-    print 'Preprocess date:', time.strftime('%Y-%m-%d', data.preprocess_date)
     
     length, = struct.unpack('i', f.read(4))
     data.phantom_name, = struct.unpack('%ds' % length, f.read(length))
-    print 'Phantom name:', data.phantom_name
     
     length, = struct.unpack('i', f.read(4))
     data.data_source, = struct.unpack('%ds' % length, f.read(length))
-    print 'Data source:', data.data_source
     
     length, = struct.unpack('i', f.read(4))
     data.prepared_by, = struct.unpack('%ds' % length, f.read(length))
-    print 'Prepared by:', data.prepared_by
     
-    length = 4 * data.num_events
+    return data
+
+def setColumns(data, columns):
+    '''Attach the rows of a (13, num_events) array to data as t, v, u and wepl.'''
+    data.t = [columns[i] for i in range(0, 4)]
+    data.v = [columns[i] for i in range(4, 8)]
+    data.u = [columns[i] for i in range(8, 12)]
+    data.wepl = columns[12]
+
+def printFirstEvent(data, level=2):
+    # skipped unless it will be printed, as it may have to decompress a chunk
+    if data.num_events == 0 or not instrument.enabled(level):
+        return
+    instrument.log('First event:', level)
+    for i in range(4):
+        instrument.log('%f %f %f' % (data.t[i][0], data.v[i][0], data.u[i][0]), level)
+    instrument.log('%f' % data.wepl[0], level)
+
+def loadData_v0(f):
+    '''Read a version 0 header and all of its event data into memory.'''
+    data = readHeader_v0(f)
+    
+    count = num_columns_v0 * data.num_events
+    with instrument.stage('read'):
+        columns = np.fromfile(f, dtype=np.float32, count=count)
+    if len(columns) != count:
+        raise Exception('File is truncated: expected %d events' % data.num_events)
+    instrument.count('events_read', data.num_events)
+    instrument.count('bytes_read', columns.nbytes)
+    setColumns(data, columns.reshape(num_columns_v0, data.num_events))
+    printFirstEvent(data)
     
-    data.t = []
-    data.t.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.t.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.t.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.t.append(struct.unpack('%df' % data.num_events, f.read(length)))
+    return data
+
+def readChunkIndex(f, data):
+    '''
+    Read the chunk size after a version 1 header, and the chunk index from 
+    the end of the file, into data.chunk_size and data.chunk_index.
+    '''
+    data.chunk_size, = struct.unpack('i', f.read(4))
+    data.data_offset = f.tell()
+    
+    trailer_size = struct.calcsize(trailer_format)
+    f.seek(-trailer_size, os.SEEK_END)
+    index_offset, num_chunks, magic_number = struct.unpack(trailer_format, f.read(trailer_size))
+    if magic_number != 'PCTI':
+        raise Exception('Chunk index not found, the file may be truncated')
+    f.seek(index_offset)
+    data.chunk_index = np.fromfile(f, dtype=chunk_index_dtype, count=num_chunks)
+    if len(data.chunk_index) != num_chunks:
+        raise Exception('Chunk index is truncated')
+    f.seek(data.data_offset)
+
+def shuffleBytes(values):
+    '''Group the bytes of an array by their position within each value.'''
+    return values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+
+def unshuffleBytes(buffer, dtype=np.float32):
+    itemsize = np.dtype(dtype).itemsize
+    shuffled = np.frombuffer(buffer, dtype=np.uint8).reshape(itemsize, -1)
+    return shuffled.T.copy().view(dtype).ravel()
+
+class ChunkedFile(object):
+    '''Reads and decompresses the columns of chunks from a version 1 file.'''
     
-    data.v = []
-    data.v.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.v.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.v.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.v.append(struct.unpack('%df' % data.num_events, f.read(length)))
+    def __init__(self, filename, chunk_size, chunk_index):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.index = chunk_index
+        self.num_events = int(chunk_index['num_events'].sum())
+        self._file = None
+        # the last chunk read of each column
+        self._last = {}
     
-    data.u = []
-    data.u.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.u.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.u.append(struct.unpack('%df' % data.num_events, f.read(length)))
-    data.u.append(struct.unpack('%df' % data.num_events, f.read(length)))
+    def readColumn(self, chunk, column):
+        last = self._last.get(column)
+        if last is not None and last[0] == chunk:
+            return last[1]
+        if self._file is None:
+            self._file = open(self.filename, 'rb')
+        entry = self.index[chunk]
+        with instrument.stage('read'):
+            self._file.seek(entry['offset'][column])
+            buffer = self._file.read(entry['length'][column])
+        with instrument.stage('decompress'):
+            values = unshuffleBytes(zlib.decompress(buffer))
+        instrument.count('bytes_read', len(buffer))
+        if len(values) != entry['num_events']:
+            raise Exception('Chunk %d of %s is corrupt' % (chunk, self.filename))
+        self._last[column] = (chunk, values)
+        return values
+
+class ChunkedColumn(object):
+    '''
+    One column of a version 1 file. It can be indexed and sliced like an 
+    array, and only the chunks that are needed get decompressed.
+    '''
     
-    data.wepl = struct.unpack('%df' % data.num_events, f.read(length))
+    dtype = np.dtype(np.float32)
     
-    print 'First event:'
-    for i in range(4):
-        print '%f %f %f' % (data.t[i][0], data.v[i][0], data.u[i][0])
-    print '%f' % data.wepl[0]
+    def __init__(self, chunked_file, column):
+        self.file = chunked_file
+        self.column = column
+    
+    def __len__(self):
+        return self.file.num_events
+    
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                # read the covering forward range, then step through it
+                if step > 0:
+                    return self[start:stop][::step]
+                if start <= stop:
+                    return np.zeros(0, dtype=self.dtype)
+                return self[stop + 1:start + 1][::step]
+            chunk_size = self.file.chunk_size
+            parts = []
+            for chunk in xrange(start // chunk_size, (stop - 1) // chunk_size + 1 if stop > start else 0):
+                values = self.file.readColumn(chunk, self.column)
+                first = chunk * chunk_size
+                parts.append(values[max(start - first, 0):stop - first])
+            if not parts:
+                return np.zeros(0, dtype=self.dtype)
+            return np.concatenate(parts)
+        
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Event index out of range')
+        chunk_size = self.file.chunk_size
+        return self.file.readColumn(index // chunk_size, self.column)[index % chunk_size]
+
+def selectChunks(data, wepl_min=None, wepl_max=None):
+    '''
+    Numbers of the chunks of a version 1 file that may contain events with 
+    WEPL between wepl_min and wepl_max, found from the index alone.
+    '''
+    selected = data.chunk_index['num_events'] > 0
+    if wepl_min is not None:
+        selected &= data.chunk_index['wepl_max'] >= wepl_min
+    if wepl_max is not None:
+        selected &= data.chunk_index['wepl_min'] <= wepl_max
+    return np.flatnonzero(selected)
+
+def readChunks(data, chunks):
+    '''
+    Read the listed chunks of a version 1 file (e.g. from selectChunks) into 
+    a Data object holding only their events.
+    '''
+    chunked_file = data.t[0].file
+    chunk = Data()
+    chunk.projection_angle = data.projection_angle
+    chunk.num_events = int(data.chunk_index['num_events'][chunks].sum())
+    columns = []
+    for column in range(num_columns_v0):
+        parts = [chunked_file.readColumn(c, column) for c in chunks]
+        columns.append(np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32))
+    setColumns(chunk, columns)
+    return chunk
+
+def loadData_v1(f):
+    '''Read a version 1 header and all of its event data into memory.'''
+    data = readHeader_v0(f)
+    readChunkIndex(f, data)
+    
+    columns = np.empty((num_columns_v0, data.num_events), dtype=np.float32)
+    start = 0
+    for entry in data.chunk_index:
+        stop = start + entry['num_events']
+        for column in range(num_columns_v0):
+            with instrument.stage('read'):
+                f.seek(entry['offset'][column])
+                buffer = f.read(entry['length'][column])
+            with instrument.stage('decompress'):
+                columns[column, start:stop] = unshuffleBytes(zlib.decompress(buffer))
+            instrument.count('bytes_read', len(buffer))
+        start = stop
+    instrument.count('events_read', data.num_events)
+    setColumns(data, columns)
+    printFirstEvent(data)
     
     return data
 
-def writeTextFile(filename, data, max=None):
-    print 'Writing data to text file:', filename
-    raise Exception('Writing text files is not yet implemented.')
+def readScanConfig(filename):
+    '''Read the u-coordinate look-up table (8 values) from a scan.cfg file.'''
+    with open(filename) as f:
+        u_coords = [float(line) for line in f if line.strip()]
+    if len(u_coords) < 8:
+        raise Exception('Expected 8 u-coordinates in %s, found %d' % (filename, len(u_coords)))
+    return u_coords[:8]
 
-def writeOldBinaryFile(filename, data, max=None):
-    print 'Writing data to old format binary file:', filename
+class LookupColumn(object):
+    '''
+    u-coordinates of one tracker plane of an old binary file. It can be 
+    indexed and sliced like an array; the look-up table indices are only 
+    resolved into coordinates for the events that are accessed.
+    '''
+    
+    dtype = np.dtype(np.float32)
+    
+    def __init__(self, indices, table):
+        self.indices = indices
+        self.table = np.asarray(table, dtype=np.float32)
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+    
+    def __getitem__(self, key):
+        return self.table[self.indices[key]]
+
+def mapOldBinaryFile(filename, config_filename=None):
+    '''
+    Open an old format .dat file as a read-only memory map of its records.
+    The u-coordinate look-up table is read from config_filename (default is 
+    scan.cfg in the same directory). The columns are the same as those of 
+    mapFile: t and v are strided views of the records, and u is resolved 
+    through the look-up table as it is accessed. The old format has no 
+    header, so only the projection angle (from the first event) is known.
+    '''
+    if config_filename is None:
+        config_filename = os.path.join(os.path.dirname(filename), 'scan.cfg')
+    u_coords = readScanConfig(config_filename)
+    
+    size = os.path.getsize(filename)
+    if size % old_binary_dtype.itemsize != 0:
+        raise Exception('File size is not a multiple of the %d byte record size' % old_binary_dtype.itemsize)
+    
+    data = Data()
+    data.num_events = size // old_binary_dtype.itemsize
+    instrument.log('Found %d events' % data.num_events, 2)
+    if data.num_events > 0:
+        records = np.memmap(filename, dtype=old_binary_dtype, mode='r')
+        data.projection_angle = float(records['angle'][0])
+    else:
+        records = np.zeros(0, dtype=old_binary_dtype)
+        data.projection_angle = 0.0
+    instrument.log('Projection angle: %s' % data.projection_angle, 2)
+    
+    data.beam_energy = None
+    data.generation_date = None
+    data.preprocess_date = None
+    data.phantom_name = ''
+    data.data_source = ''
+    data.prepared_by = ''
+    data.records = records
+    data.t = [records['t'][:, i] for i in range(4)]
+    data.v = [records['v'][:, i] for i in range(4)]
+    data.u = [LookupColumn(records['u'][:, i], u_coords) for i in range(4)]
+    data.wepl = records['wepl']
+    printFirstEvent(data)
+    return data
+
+def writeTextFile(filename, data, max=None, chunk_size=default_chunk_size, precision=6, selection=None):
+    '''
+    Write one event per line: v[0..3], t[0..3], u[0..3], wepl and projection 
+    angle, with precision decimal places.
+    '''
+    instrument.log('Writing data to text file: %s' % filename)
+    
+    num_events = countOutputEvents(data, max, selection, chunk_size)
+    
+    num_written = 0
+    with open(filename, 'w') as f:
+        for chunk in iterOutputChunks(data, num_events, chunk_size, selection):
+            with instrument.stage('format'):
+                angle = np.empty(chunk.num_events)
+                angle.fill(chunk.projection_angle)
+                columns = chunk.v + chunk.t + chunk.u + [chunk.wepl, angle]
+                textio.writeArray(f, np.column_stack(columns), precision)
+            written(chunk, num_events)
+            num_written += chunk.num_events
+        instrument.count('bytes_written', f.tell())
+    
+    instrument.log('Done writing to file', 2)
+    return num_written
+
+def iterChunks(data, chunk_size=default_chunk_size, max=None, fields=('t', 'v', 'u', 'wepl')):
+    '''
+    Yield the events of data as Data blocks of at most chunk_size events, 
+    stopping after the first max events. Only the named fields are copied 
+    into the blocks, so memory use is bounded by chunk_size and not by the 
+    size of the projection. The events and bytes copied from the file are 
+    counted as events_read and bytes_read (on every pass over the data).
+    '''
+    num_events = data.num_events if max is None else min(data.num_events, max)
+    for start in xrange(0, num_events, chunk_size):
+        stop = min(start + chunk_size, num_events)
+        chunk = Data()
+        chunk.num_events = stop - start
+        chunk.first_event = start
+        chunk.projection_angle = data.projection_angle
+        num_bytes = 0
+        with instrument.stage('read'):
+            for field in fields:
+                columns = getattr(data, field)
+                if field == 'wepl':
+                    setattr(chunk, field, np.array(columns[start:stop]))
+                    num_bytes += storedBytes(columns, chunk.num_events)
+                else:
+                    setattr(chunk, field, [np.array(column[start:stop]) for column in columns])
+                    num_bytes += sum(storedBytes(column, chunk.num_events) for column in columns)
+        instrument.count('events_read', chunk.num_events)
+        instrument.count('bytes_read', num_bytes)
+        yield chunk
+
+def storedBytes(column, num_events):
+    '''Number of bytes of num_events values of column in its file.'''
+    if isinstance(column, ChunkedColumn):
+        # counted as the chunks are read, compressed
+        return 0
+    if isinstance(column, LookupColumn):
+        return num_events * column.indices.dtype.itemsize
+    return num_events * np.dtype(column.dtype).itemsize
+
+def takeEvents(chunk, selected):
+    '''A new chunk holding the selected events (boolean mask, indices or slice) of chunk.'''
+    result = Data()
+    result.projection_angle = chunk.projection_angle
+    result.first_event = chunk.first_event
+    for field in ('t', 'v', 'u'):
+        if hasattr(chunk, field):
+            setattr(result, field, [column[selected] for column in getattr(chunk, field)])
+    result.wepl = chunk.wepl[selected]
+    result.num_events = len(result.wepl)
+    return result
+
+def joinChunks(chunks):
+    '''Concatenate a list of chunks into one.'''
+    if len(chunks) == 1:
+        return chunks[0]
+    result = Data()
+    result.projection_angle = chunks[0].projection_angle
+    result.first_event = chunks[0].first_event
+    for field in ('t', 'v', 'u'):
+        columns = zip(*[getattr(chunk, field) for chunk in chunks])
+        setattr(result, field, [np.concatenate(column) for column in columns])
+    result.wepl = np.concatenate([chunk.wepl for chunk in chunks])
+    result.num_events = len(result.wepl)
+    return result
+
+def isocenterPosition(chunk):
+    '''
+    (t, v) at which each event crosses u = 0: the average of the straight 
+    tracks through the front (0, 1) and rear (2, 3) tracker planes.
+    '''
+    positions = []
+    for coordinate in (chunk.t, chunk.v):
+        estimates = []
+        for a, b, near in ((0, 1, 1), (2, 3, 2)):
+            du = chunk.u[b] - chunk.u[a]
+            slope = (coordinate[b] - coordinate[a]) / np.where(du != 0, du, 1)
+            slope[du == 0] = 0
+            estimates.append(coordinate[near] - slope * chunk.u[near])
+        positions.append((estimates[0] + estimates[1]) / 2)
+    return positions
+
+def combineStatistics(na, ma, sa, nb, mb, sb):
+    '''
+    Count, mean and sum of squared deviations of two sets of values combined, 
+    from those of each set (pairwise update of Chan et al.). Works on arrays 
+    of statistics element by element; empty sets have a mean of 0.
+    '''
+    n = na + nb
+    delta = mb - ma
+    mean = ma + delta * nb / np.maximum(n, 1)
+    squares = sa + sb + delta**2 * na * nb / np.maximum(n, 1)
+    return n, mean, squares
+
+class EventSelection(object):
+    '''
+    Event cuts and random subsampling, applied to each chunk of a projection 
+    between reading and writing.
+    
+    wepl: (min, max) WEPL range
+    t_window, v_window: (min, max) range that t (or v) must be within on all 
+        four tracker planes
+    angles: projection angles to keep (degrees); other projections are skipped
+    angle_tolerance: largest difference (degrees) to count as the same angle
+    sigma: reject events whose WEPL is more than sigma standard deviations 
+        from the mean of their (t, v) bin, using the position at u = 0
+    bin_size: size (mm) of the (t, v) bins for sigma
+    subsample: keep this many events per projection, chosen uniformly at 
+        random from those that pass the cuts
+    seed: random seed for subsample
+    
+    prepare() has to be called for each projection before apply(). It makes 
+    the passes over the data that the outlier cut and subsampling need (or 
+    that counting the selected events needs). The subsample is then drawn 
+    chunk by chunk in apply(), so its memory use does not grow with the 
+    number of events.
+    '''
     
-    if max is None:
+    def __init__(self, wepl=None, t_window=None, v_window=None, angles=None, angle_tolerance=0.01, 
+                 sigma=None, bin_size=2.0, subsample=None, seed=None):
+        self.wepl = wepl
+        self.t_window = t_window
+        self.v_window = v_window
+        self.angles = angles
+        self.angle_tolerance = angle_tolerance
+        self.sigma = sigma
+        self.bin_size = bin_size
+        self.subsample = subsample
+        self.seed = seed
+        self._reset()
+    
+    def _reset(self):
+        self._bins = None
+        self._random = None
+        # events passing the cuts not yet seen by apply(), and how many of them to keep
+        self._remaining_passed = None
+        self._remaining_needed = None
+    
+    def acceptsAngle(self, projection_angle):
+        if self.angles is None:
+            return True
+        difference = np.abs(np.asarray(self.angles, dtype=float) - projection_angle)
+        return bool(np.any(difference <= self.angle_tolerance))
+    
+    def _cuts(self, chunk):
+        '''Boolean mask of the events of chunk that pass the WEPL, t and v cuts.'''
+        keep = np.ones(chunk.num_events, dtype=bool)
+        if self.wepl is not None:
+            keep &= (chunk.wepl >= self.wepl[0]) & (chunk.wepl <= self.wepl[1])
+        for window, columns in ((self.t_window, chunk.t), (self.v_window, chunk.v)):
+            if window is not None:
+                for column in columns:
+                    keep &= (column >= window[0]) & (column <= window[1])
+        return keep
+    
+    def _binKeys(self, chunk):
+        '''One int64 per event identifying its (t, v) bin.'''
+        t, v = isocenterPosition(chunk)
+        t_bin = np.floor(t / self.bin_size).astype(np.int64)
+        v_bin = np.floor(v / self.bin_size).astype(np.int64)
+        return (t_bin << 32) + (v_bin & 0xffffffff)
+    
+    def _accumulateBins(self, data, chunk_size):
+        '''Pass over the events that pass the cuts, to find the WEPL mean and 
+        standard deviation of each (t, v) bin.'''
+        bin_keys = np.zeros(0, dtype=np.int64)
+        counts, means, squares = np.zeros(0), np.zeros(0), np.zeros(0)
+        for chunk in iterChunks(data, chunk_size):
+            chunk = takeEvents(chunk, self._cuts(chunk))
+            if chunk.num_events == 0:
+                continue
+            keys, inverse = np.unique(self._binKeys(chunk), return_inverse=True)
+            wepl = chunk.wepl.astype(float)
+            chunk_counts = np.bincount(inverse).astype(float)
+            chunk_means = np.bincount(inverse, wepl) / chunk_counts
+            chunk_squares = np.bincount(inverse, (wepl - chunk_means[inverse])**2)
+            
+            # merge with the running totals
+            all_keys = np.union1d(bin_keys, keys)
+            merged = []
+            for old_keys, values in ((bin_keys, (counts, means, squares)), (keys, (chunk_counts, chunk_means, chunk_squares))):
+                position = np.searchsorted(all_keys, old_keys)
+                expanded = []
+                for value in values:
+                    expanded.append(np.zeros(len(all_keys)))
+                    expanded[-1][position] = value
+                merged.append(expanded)
+            counts, means, squares = combineStatistics(*(merged[0] + merged[1]))
+            bin_keys = all_keys
+        
+        self._bins = bin_keys, means, np.sqrt(squares / np.maximum(counts, 1))
+    
+    def _select(self, chunk):
+        keep = self._cuts(chunk)
+        if self.sigma is not None and self._bins is not None:
+            bin_keys, means, sigmas = self._bins
+            keys = self._binKeys(chunk)
+            if len(bin_keys) == 0:
+                return keep & False
+            index = np.minimum(np.searchsorted(bin_keys, keys), len(bin_keys) - 1)
+            keep &= bin_keys[index] == keys
+            keep &= np.abs(chunk.wepl - means[index]) <= self.sigma * sigmas[index]
+        return keep
+    
+    def prepare(self, data, chunk_size=default_chunk_size, count=False):
+        '''
+        Get ready to select events from the projection in data.
+        Returns the number of events that will be selected, or None if 
+        finding it would take a pass over the data that the selection does 
+        not need itself (unless count is True).
+        '''
+        self._reset()
+        if not self.acceptsAngle(data.projection_angle):
+            self._remaining_needed = 0
+            return 0
+        if self.sigma is not None:
+            self._accumulateBins(data, chunk_size)
+        if self.subsample is None and not count:
+            return None
+        
+        num_passed = 0
+        for chunk in iterChunks(data, chunk_size):
+            num_passed += np.count_nonzero(self._select(chunk))
+        
+        if self.subsample is not None and self.subsample < num_passed:
+            self._random = np.random.RandomState(self.seed)
+            self._remaining_passed = num_passed
+            self._remaining_needed = self.subsample
+            return self.subsample
+        return num_passed
+    
+    def _numChosen(self, num_passed):
+        '''
+        Number of the num_passed events of a chunk to keep, drawn so that 
+        every subset of the events of the projection is equally likely.
+        '''
+        if self._remaining_needed == 0 or num_passed == 0:
+            return 0
+        if num_passed >= self._remaining_passed:
+            return self._remaining_needed
+        return int(self._random.hypergeometric(num_passed, self._remaining_passed - num_passed, self._remaining_needed))
+    
+    def apply(self, chunk):
+        '''Returns a chunk with only the selected events of chunk.'''
+        if self._remaining_needed == 0:
+            return takeEvents(chunk, slice(0, 0))
+        keep = np.flatnonzero(self._select(chunk))
+        if self._random is not None:
+            num_chosen = self._numChosen(len(keep))
+            chosen = np.sort(self._random.choice(len(keep), num_chosen, replace=False))
+            self._remaining_passed -= len(keep)
+            self._remaining_needed -= num_chosen
+            keep = keep[chosen]
+        return takeEvents(chunk, keep)
+
+def countOutputEvents(data, max=None, selection=None, chunk_size=default_chunk_size, exact=False):
+    '''
+    Number of events that will be written from data, after selection and max.
+    Counting the events kept by a selection takes an extra pass over the 
+    data, which is only made if the selection needs it anyway or exact is 
+    True. Otherwise the result is only an upper bound: max, or None.
+    '''
+    if selection is None:
         num_events = data.num_events
     else:
-        num_events = min(data.num_events, max)
-        print 'Limiting output to %d events' % num_events
+        with instrument.stage('select'):
+            num_events = selection.prepare(data, chunk_size, exact)
+        if num_events is not None:
+            instrument.log('Selected %d of %d events' % (num_events, data.num_events))
+    if max is not None and (num_events is None or max < num_events):
+        if num_events is not None:
+            instrument.log('Limiting output to %d events' % max)
+        num_events = max
+    return num_events
+
+def written(chunk, num_events):
+    '''
+    Count a chunk of events as written, and report the progress of the file 
+    (num_events is the total from countOutputEvents, which may be a bound).
+    '''
+    instrument.count('events_written', chunk.num_events)
+    instrument.progress('write', chunk.first_event + chunk.num_events, num_events)
+
+def iterOutputChunks(data, num_events, chunk_size=default_chunk_size, selection=None):
+    '''
+    Yield the first num_events events to write from data (all of them if 
+    num_events is None), after selection, in chunks of chunk_size events 
+    (the last one may be shorter). The first_event of each chunk is its 
+    position in the output.
+    '''
+    if selection is None:
+        for chunk in iterChunks(data, chunk_size, num_events):
+            yield chunk
+        return
+    if num_events == 0:
+        return
+    
+    if num_events is None:
+        num_events = data.num_events
+    
+    num_written = 0
+    pending = []
+    num_pending = 0
+    chunks = iterChunks(data, chunk_size)
+    while True:
+        chunk = next(chunks, None)
+        if chunk is not None:
+            with instrument.stage('select'):
+                chunk = selection.apply(chunk)
+            pending.append(chunk)
+            num_pending += chunk.num_events
+        # the last events are written once the data runs out
+        while num_pending >= chunk_size or (num_pending > 0 and (chunk is None or num_written + num_pending >= num_events)):
+            with instrument.stage('select'):
+                joined = joinChunks(pending)
+                size = min(chunk_size, num_events - num_written, num_pending)
+                output = takeEvents(joined, slice(0, size))
+            output.first_event = num_written
+            yield output
+            num_written += size
+            if num_written >= num_events:
+                return
+            pending = [takeEvents(joined, slice(size, None))]
+            num_pending = joined.num_events - size
+        if chunk is None:
+            return
+
+def uniqueInOrder(column, known=()):
+    '''
+    Distinct values of column in order of first appearance, appended to the 
+    list of already known values.
+    '''
+    values = list(known)
+    column = np.asarray(column)
+    new = np.ones(column.shape, dtype=bool)
+    for value in values:
+        new &= column != value
+    if new.any():
+        column = column[new]
+        new_values, first_index = np.unique(column, return_index=True)
+        values.extend(new_values[np.argsort(first_index)].tolist())
+    return values
+
+def makeUCoordinateTable(data, chunk_size=default_chunk_size, max=None):
+    '''
+    Create the u-coordinate look-up table for the old formats: the two 
+    distinct u values of each of the four tracker planes, among the first 
+    max events (default is all). Only the u columns are read, one chunk at 
+    a time.
+    '''
+    u_values = [[] for i in range(4)]
+    for chunk in iterChunks(data, chunk_size, max, fields=('u',)):
+        for i in range(4):
+            u_values[i] = uniqueInOrder(chunk.u[i], u_values[i])
+            if len(u_values[i]) > 2:
+                raise Exception('Error converting u-coordinate arrays to look-up table')
     
-    # create the u-coordinate look-up table
     u_coords = []
     for i in range(4):
-        u_set = list(set(data.u[i]))
-        if len(u_set) != 2:
-            if len(u_set) > 2:
-                raise Exception('Error converting u-coordinate arrays to look-up table')
-            elif len(u_set) == 1:
-                u_set *= 2
+        u_set = list(set(u_values[i]))
+        if len(u_set) == 1:
+            u_set *= 2
         u_coords.extend(u_set)
+    return u_coords
+
+def lookupIndices(values, table):
+    '''
+    Index of each value in table, like table.index(value) (i.e. the first 
+    matching entry), for a whole array of values at once.
+    '''
+    values = np.asarray(values)
+    table = np.asarray(table, dtype=np.float64)
+    # stable sort, so equal entries keep their order and the first one wins
+    order = np.argsort(table, kind='mergesort')
+    sorted_table = table[order]
+    positions = np.searchsorted(sorted_table, values, side='left')
+    positions = np.minimum(positions, len(table) - 1)
+    if not np.all(sorted_table[positions] == values):
+        raise ValueError('Value not found in look-up table')
+    return order[positions]
+
+def writeOldBinaryFile(filename, data, max=None, chunk_size=default_chunk_size, selection=None):
+    instrument.log('Writing data to old format binary file: %s' % filename)
     
+    num_events = countOutputEvents(data, max, selection, chunk_size)
+    
+    # the table has to cover every event written. Without a selection those 
+    # are the first num_events; the events kept by a selection can come from 
+    # anywhere in the file, so then all of them are scanned.
+    with instrument.stage('convert'):
+        u_coords = makeUCoordinateTable(data, chunk_size, num_events if selection is None else None)
+    
+    # every projection of a scan shares scan.cfg, and other processes may be 
+    # writing it at the same time, so replace it atomically
     config_filename = os.path.join(os.path.dirname(filename), 'scan.cfg')
-    with open(config_filename, 'w') as f:
+    temp_filename = '%s.%d' % (config_filename, os.getpid())
+    with open(temp_filename, 'w') as f:
         for i in range(8):
             f.write('%f\n' % u_coords[i])
+    os.rename(temp_filename, config_filename)
+    
+    num_written = 0
+    with open(filename, 'wb') as f:
+        for chunk in iterOutputChunks(data, num_events, chunk_size, selection):
+            with instrument.stage('convert'):
+                records = np.zeros(chunk.num_events, dtype=old_binary_dtype)
+                for n in range(4):
+                    records['v'][:, n] = chunk.v[n]
+                    records['t'][:, n] = chunk.t[n]
+                    records['u'][:, n] = lookupIndices(chunk.u[n], u_coords)
+                records['wepl'] = chunk.wepl
+                records['angle'] = chunk.projection_angle
+            with instrument.stage('write'):
+                records.tofile(f)
+            written(chunk, num_events)
+            num_written += chunk.num_events
+        instrument.count('bytes_written', f.tell())
+    
+    instrument.log('Done writing to file', 2)
+    return num_written
+    
+def writeHeader_v0(f, data, num_events, version_id=0):
+    '''Write the magic number, version and header shared by versions 0 and 1.'''
+    f.write(struct.pack('4si', 'PCTD', version_id))
+    f.write(struct.pack('i', num_events))
+    f.write(struct.pack('ff', data.projection_angle, getattr(data, 'beam_energy', None) or 0))
+    for date in (getattr(data, 'generation_date', None), getattr(data, 'preprocess_date', None)):
+        if isinstance(date, time.struct_time):
+            date = time.mktime(date)
+        f.write(struct.pack('i', int(date or 0)))
+    for name in ('phantom_name', 'data_source', 'prepared_by'):
+        value = getattr(data, name, None) or ''
+        f.write(struct.pack('i', len(value)) + value)
+
+def columnsOf(chunk):
+    '''The 13 columns of a chunk in file order: t[0..3], v[0..3], u[0..3], wepl.'''
+    return chunk.t + chunk.v + chunk.u + [chunk.wepl]
+
+def writeNewBinaryFile(filename, data, version=1, max=None, chunk_size=default_chunk_size, compression_level=1, selection=None):
+    '''
+    Write data to a .bin file in version 0 (uncompressed columns) or 
+    version 1 (compressed chunks with an index) format.
+    '''
+    instrument.log('Writing data to version %d binary file: %s' % (version, filename))
     
+    # version 0 lays out its columns by the number of events, so it has to 
+    # be known before writing
+    num_events = countOutputEvents(data, max, selection, chunk_size, exact=(version == 0))
+    
+    num_written = 0
     with open(filename, 'wb') as f:
-        for i in range(num_events):
-            data_word = []
-            for n in range(4):
-                f.write(struct.pack('f', data.v[n][i]))
-            for n in range(4):
-                f.write(struct.pack('f', data.t[n][i]))
-            for n in range(4):
-                f.write(struct.pack('B', u_coords.index(data.u[n][i])))
-            f.write(struct.pack('ffI', data.wepl[i], data.projection_angle, 0)) # last int is a dummy for alignment
-    
-    print 'Done writing to file'
+        writeHeader_v0(f, data, num_events or 0, version)
+        
+        if version == 0:
+            offset = f.tell()
+            f.truncate(offset + 4 * num_columns_v0 * num_events)
+            for chunk in iterOutputChunks(data, num_events, chunk_size, selection):
+                for column, values in enumerate(columnsOf(chunk)):
+                    with instrument.stage('convert'):
+                        values = np.asarray(values, dtype=np.float32)
+                    with instrument.stage('write'):
+                        f.seek(offset + 4 * (column * num_events + chunk.first_event))
+                        values.tofile(f)
+                written(chunk, num_events)
+                num_written += chunk.num_events
+        
+        elif version == 1:
+            f.write(struct.pack('i', chunk_size))
+            index = []
+            for chunk in iterOutputChunks(data, num_events, chunk_size, selection):
+                entry = np.zeros(1, dtype=chunk_index_dtype)[0]
+                entry['num_events'] = chunk.num_events
+                entry['wepl_min'] = chunk.wepl.min()
+                entry['wepl_max'] = chunk.wepl.max()
+                for column, values in enumerate(columnsOf(chunk)):
+                    with instrument.stage('compress'):
+                        buffer = zlib.compress(shuffleBytes(np.asarray(values, dtype=np.float32)), compression_level)
+                    with instrument.stage('write'):
+                        entry['offset'][column] = f.tell()
+                        entry['length'][column] = len(buffer)
+                        f.write(buffer)
+                index.append(entry)
+                written(chunk, num_events)
+                num_written += chunk.num_events
+            index_offset = f.tell()
+            np.array(index, dtype=chunk_index_dtype).tofile(f)
+            f.write(struct.pack(trailer_format, index_offset, len(index), 'PCTI'))
+            if num_written != num_events:
+                # the selected events were only counted as they were written
+                f.seek(struct.calcsize('4si'))
+                f.write(struct.pack('i', num_written))
+                f.seek(0, os.SEEK_END)
+        
+        else:
+            raise Exception('Unknown data format version')
+        instrument.count('bytes_written', f.tell())
+    
+    instrument.log('Done writing to file', 2)
+    return num_written
+
+# input file types: (extension, description)
+input_types = {'bin': ('.bin', 'new format'),
+               'dat': ('.dat', 'old binary format'),
+               'txt': ('.txt', 'old text format')}
+
+def findInputFiles(inputdir, input_type=None):
+    '''
+    List the pCT data files in inputdir. input_type is one of the keys of 
+    input_types, or 'all'. If it is None, the directory must only contain 
+    one type of file.
+    '''
+    filelists = {}
+    for name in sorted(input_types):
+        extension, description = input_types[name]
+        filelist = sorted(glob.glob(os.path.join(inputdir, '*' + extension)))
+        if len(filelist) > 0:
+            filelists[name] = filelist
+            instrument.log('Found %d file%s in the %s' % (len(filelist), '' if len(filelist) == 1 else 's', description))
+    
+    if len(filelists) == 0:
+        raise ValueError('No pCT data files found!')
     
+    if input_type is None:
+        if len(filelists) > 1:
+            raise ValueError('More than one file type found (%s), use --input-type to choose' % ', '.join(sorted(filelists)))
+        input_type = filelists.keys()[0]
+    
+    if input_type == 'all':
+        return sum([filelists[name] for name in sorted(filelists)], [])
+    return filelists.get(input_type, [])
+
+def convertFile(filename, outputdir, text=False, version=None, max=None, chunk_size=default_chunk_size, precision=6, selection=None):
+    '''
+    Convert one data file into outputdir, optionally selecting events with 
+    an EventSelection.
+    Returns the output filename (None if the projection angle was not 
+    selected) and the number of events written.
+    '''
+    data = readFile(filename)
+    if selection is not None and not selection.acceptsAngle(data.projection_angle):
+        instrument.log('Skipping projection at angle %s' % data.projection_angle)
+        instrument.log()
+        return None, 0
+    filename = os.path.join(outputdir, os.path.basename(filename))
+    if version is None:
+        filename, ext = os.path.splitext(filename)
+        if text:
+            filename += '.txt'
+            num_events = writeTextFile(filename, data, max, chunk_size, precision, selection)
+        else:
+            filename += '.dat'
+            num_events = writeOldBinaryFile(filename, data, max, chunk_size, selection)
+    else:
+        filename, ext = os.path.splitext(filename)
+        filename += '.bin'
+        num_events = writeNewBinaryFile(filename, data, version, max, chunk_size, selection=selection)
+    instrument.count('files_written')
+    instrument.log()
+    return filename, num_events
+
+def _convertFileJob(job):
+    '''
+    Run convertFile for one (filename, options, separate) job, catching its 
+    errors so that one bad file does not stop the others. If separate is 
+    True (in a worker process), its times and counters are recorded 
+    separately and returned as a report, for the parent to merge.
+    Returns (filename, num_events, num_bytes, error message or None, report or None).
+    '''
+    filename, options, separate = job
+    if separate:
+        result, report = instrument.recordSeparately(_convertFileJob, ((filename, options, False),))
+        return result[:4] + (report,)
+    
+    try:
+        output_filename, num_events = convertFile(filename, **options)
+        num_bytes = os.path.getsize(output_filename) if output_filename else 0
+    except Exception:
+        return filename, 0, 0, traceback.format_exc(), None
+    return filename, num_events, num_bytes, None, None
+
+def convertFiles(filelist, outputdir, jobs=1, **options):
+    '''
+    Convert a list of files, using a pool of jobs processes.
+    Returns a list of (filename, num_events, num_bytes, error) results.
+    The times and counters of the workers are merged into the current 
+    instrument Recorder, and progress is reported as ('files', done, total).
+    '''
+    options['outputdir'] = outputdir
+    job_list = [(filename, options, jobs != 1) for filename in filelist]
+    if jobs == 1:
+        results = imap(_convertFileJob, job_list)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_convertFileJob, job_list)
+    
+    try:
+        done = []
+        for result in results:
+            if result[4] is not None:
+                instrument.current().merge(result[4])
+            done.append(result[:4])
+            instrument.progress('files', len(done), len(job_list))
+    finally:
+        if jobs != 1:
+            pool.close()
+            pool.join()
+    return done
+
+def printSummary(results, elapsed):
+    failed = [result for result in results if result[3] is not None]
+    num_events = sum(result[1] for result in results)
+    num_bytes = sum(result[2] for result in results)
+    
+    # failures are reported even in quiet mode
+    for filename, _, _, error in failed:
+        instrument.log('Failed to convert %s:' % filename, 0)
+        instrument.log(error, 0)
+    
+    instrument.log('Converted %d of %d files' % (len(results) - len(failed), len(results)))
+    instrument.log('Events written: %d' % num_events)
+    instrument.log('Bytes written: %d (%.1f MB)' % (num_bytes, num_bytes / 1e6))
+    instrument.log('Wall time: %.2f s' % elapsed)
+    if elapsed > 0:
+        instrument.log('Throughput: %.0f events/s, %.1f MB/s' % (num_events / elapsed, num_bytes / 1e6 / elapsed))
+    instrument.log()
+    instrument.log('Time per stage:')
+    instrument.current().printSummary()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert pCT scan data between formats')
     parser.add_argument('-t', '--text', dest='text', action='store_true', default=False, help='Output to text format (default is binary)')
     parser.add_argument('-v', dest='version', type=int, help='Update to VERSION (default is to downgrade)')
     parser.add_argument('-m', '--max', type=int, help='Maximum number of histories per projection to output')
+    parser.add_argument('-c', '--chunk-size', type=int, default=default_chunk_size, help='Number of histories to convert at a time (default is %(default)d)')
+    parser.add_argument('-p', '--precision', type=int, default=6, help='Number of decimal places in text output (default is %(default)d)')
+    parser.add_argument('--wepl', type=float, nargs=2, metavar=('MIN', 'MAX'), help='Only keep histories with WEPL in this range')
+    parser.add_argument('--t-window', type=float, nargs=2, metavar=('MIN', 'MAX'), help='Only keep histories with t in this range on every tracker plane')
+    parser.add_argument('--v-window', type=float, nargs=2, metavar=('MIN', 'MAX'), help='Only keep histories with v in this range on every tracker plane')
+    parser.add_argument('--angles', type=float, nargs='+', metavar='ANGLE', help='Only convert projections at these angles')
+    parser.add_argument('--sigma', type=float, help='Reject histories with WEPL more than SIGMA standard deviations from the mean of their (t, v) bin')
+    parser.add_argument('--bin-size', type=float, default=2.0, help='Size of the (t, v) bins for --sigma in mm (default is %(default)g)')
+    parser.add_argument('--subsample', type=int, metavar='N', help='Keep N randomly chosen histories per projection (after the other cuts)')
+    parser.add_argument('--seed', type=int, help='Random seed for --subsample')
+    parser.add_argument('-i', '--input-type', choices=sorted(input_types) + ['all'], help='Type of input files to convert (required if the input directory contains more than one type)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to convert in parallel (default is %(default)d)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only print errors')
+    parser.add_argument('--verbose', action='store_true', help='Also print the header and first event of every file')
+    parser.add_argument('--report', metavar='FILE', help='Write the stage times and counters of the run to FILE as JSON')
     parser.add_argument('inputdir', help='Input directory')
     parser.add_argument('outputdir', help='Output directory')
     
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
     
-    print 'Input directory:', args.inputdir
-    file_types = 0
+    instrument.configure(verbosity=0 if args.quiet else 2 if args.verbose else 1)
     
-    new_filelist = glob.glob(os.path.join(args.inputdir, '*.bin'))
-    if len(new_filelist) > 0:
-        file_types += 1
-        print 'Found %d file%s in the new format' % (len(new_filelist), '' if len(new_filelist) == 1 else 's')
-        
-    old_binary_filelist = glob.glob(os.path.join(args.inputdir, '*.dat'))
-    if len(old_binary_filelist) > 0:
-        file_types += 1
-        print 'Found %d file%s in the old binary format' % (len(old_binary_filelist), '' if len(old_binary_filelist) == 1 else 's')
-        
-    old_text_filelist = glob.glob(os.path.join(args.inputdir, '*.txt'))
-    if len(old_text_filelist) > 0:
-        file_types += 1
-        print 'Found %d file%s in the old text format' % (len(old_text_filelist), '' if len(old_text_filelist) == 1 else 's')
-    
-    if file_types == 0:
-        raise Exception('No pCT data files found!')
-    elif file_types > 1:
-        print '-> More than one file type found.'
-        print 'Which type should be used for input?'
-        
-        choices = []
-        if len(new_filelist) > 0:
-            choices.append('New files')
-        if len(old_binary_filelist) > 0:
-            choices.append('Old binary files')
-        if len(old_text_filelist) > 0:
-            choices.append('Old text files')
+    instrument.log('Input directory: %s' % args.inputdir)
+    try:
+        filelist = findInputFiles(args.inputdir, args.input_type)
+    except ValueError as e:
+        parser.error(str(e))
         
-        inputs = [str(i+1) for i in range(len(choices))]
-        inputs.extend(['a', 'q'])
-        
-        for i, choice in enumerate(inputs):
-            try:
-                choice_name = choices[i]
-            except IndexError:
-                if choice == 'a':
-                    choice_name = 'All'
-                if choice == 'q':
-                    choice_name = 'Quit'
-            print '%s) %s' % (choice, choice_name)
-        
-        user_input = ''
-        while user_input not in inputs:
-            user_input = raw_input('--> ')
-            user_input.lower()
-        
-        if user_input == 'q':
-            sys.exit()
-        if user_input == 'a':
-            filelist = new_filelist + old_binary_filelist + old_text_filelist
-        else:
-            filelist = [new_filelist, old_binary_filelist, old_text_filelist]
-            filelist = filelist[int(user_input) - 1]
-    else:
-        # only one file type found, so the other lists are just empty 
-        # (and it won't hurt to join them together)
-        filelist = new_filelist + old_binary_filelist + old_text_filelist
-        
-    print 'Output directory:', args.outputdir
+    instrument.log('Output directory: %s' % args.outputdir)
     try: 
         os.mkdir(args.outputdir)
     except OSError as e: 
@@ -240,19 +1127,18 @@ if __name__ == '__main__':
         else:
             raise
     
-    for filename in filelist:
-        data = readFile(filename)
-        filename = os.path.join(args.outputdir, os.path.basename(filename))
-        if args.version is None:
-            filename, ext = os.path.splitext(filename)
-            if args.text:
-                filename += '.txt'
-                writeTextFile(filename, data, args.max)
-            else:
-                filename += '.dat'
-                writeOldBinaryFile(filename, data, args.max)
-        else:
-            raise Exception('Writing to new data formats is not yet implemented.')
-        print
+    selection = None
+    if any(option is not None for option in (args.wepl, args.t_window, args.v_window, args.angles, args.sigma, args.subsample)):
+        selection = EventSelection(args.wepl, args.t_window, args.v_window, args.angles, 
+                                   sigma=args.sigma, bin_size=args.bin_size, subsample=args.subsample, seed=args.seed)
+    
+    start = time.time()
+    results = convertFiles(filelist, args.outputdir, args.jobs, text=args.text, version=args.version, max=args.max, 
+                           chunk_size=args.chunk_size, precision=args.precision, selection=selection)
+    printSummary(results, time.time() - start)
+    if args.report:
+        instrument.current().writeReport(args.report)
     
-    print 'Done'
+    if any(result[3] is not None for result in results):
+        sys.exit(1)
+    instrument.log('Done')
@@ -21,88 +21,321 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import errno
+import threading
+import collections
+import multiprocessing.pool
 import numpy as np
 import matplotlib.pyplot as plot
-import matplotlib as mpl
-import roi as pctroi
+import render as pctrender
 
-def iterable(y):
-	try: iter(y)
-	except: return 0
-	return 1
+def readSliceText(filename):
+	'''Parse a text slice file: one row of pixels per line, separated by any whitespace.'''
+	with open(filename) as file:
+		text = file.read()
+	lines = [line for line in text.splitlines() if line.strip()]
+	if not lines:
+		raise ValueError('Slice file %s is empty' % filename)
+	num_columns = len(lines[0].split())
+	pixels = np.fromstring(text, dtype=float, sep=' ')
+	if pixels.size != len(lines) * num_columns:
+		raise ValueError('Slice file %s does not contain a rectangular array of numbers' % filename)
+	return pixels.reshape(len(lines), num_columns)
+
+def probeSliceShape(filename):
+	'''Find the (rows, columns) of a slice file without parsing it: from the 
+	header of a valid .npy copy if there is one, otherwise by counting the 
+	values on the first line and the number of lines.'''
+	pixels = readSliceCache(filename)
+	if pixels is not None:
+		return pixels.shape
+	num_rows = 0
+	num_columns = None
+	with open(filename, 'rb') as file:
+		for line in file:
+			if line.strip():
+				if num_columns is None:
+					num_columns = len(line.split())
+				num_rows += 1
+	if num_columns is None:
+		raise ValueError('Slice file %s is empty' % filename)
+	return num_rows, num_columns
+
+def sliceCacheFilename(filename):
+	return filename + '.npy'
+
+def readSliceCache(filename):
+	'''Returns a read-only memmap of the binary copy of a slice file, or None 
+	if there is none or the text file has been modified since it was made.'''
+	cache_filename = sliceCacheFilename(filename)
+	try:
+		# utime only keeps about microsecond precision
+		if abs(os.path.getmtime(cache_filename) - os.path.getmtime(filename)) > 1e-3:
+			return None
+		return np.load(cache_filename, mmap_mode='r')
+	except (IOError, OSError, ValueError):
+		return None
+
+def writeSliceCache(filename, pixels):
+	'''Save a binary copy of a slice file next to it. The copy gets the same 
+	modification time as the text file, which is how it is validated.'''
+	cache_filename = sliceCacheFilename(filename)
+	temp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+	try:
+		with open(temp_filename, 'wb') as file:
+			np.save(file, pixels)
+		mtime = os.path.getmtime(filename)
+		os.utime(temp_filename, (mtime, mtime))
+		os.rename(temp_filename, cache_filename)
+	except (IOError, OSError) as e:
+		# a read-only directory just means no cache
+		if e.errno not in (errno.EACCES, errno.EROFS, errno.EPERM):
+			raise
+
+class SliceCache(object):
+	'''Least recently used cache of slice pixel arrays, bounded by their 
+	total size in bytes. The most recently used slice is always kept.'''
+	
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.nbytes = 0
+		self._items = collections.OrderedDict()
+		self._lock = threading.Lock()
+	
+	def __contains__(self, key):
+		return key in self._items
+	
+	def get(self, key):
+		with self._lock:
+			pixels = self._items.pop(key, None)
+			if pixels is not None:
+				self._items[key] = pixels
+			return pixels
+	
+	def put(self, key, pixels, cold=False):
+		'''Add pixels as the most recently used entry. With cold, they are 
+		added as the least recently used one instead, and only if that does 
+		not evict anything (for prefetching). Returns whether they were added.'''
+		with self._lock:
+			old = self._items.pop(key, None)
+			if old is not None:
+				self.nbytes -= old.nbytes
+			if cold:
+				if self.nbytes + pixels.nbytes > self.max_bytes:
+					if old is not None:
+						self._items[key] = old
+						self.nbytes += old.nbytes
+					return False
+				self._items = collections.OrderedDict([(key, pixels)] + self._items.items())
+				self.nbytes += pixels.nbytes
+				return True
+			self._items[key] = pixels
+			self.nbytes += pixels.nbytes
+			while self.nbytes > self.max_bytes and len(self._items) > 1:
+				key, old = self._items.popitem(last=False)
+				self.nbytes -= old.nbytes
+			return True
+	
+	def discard(self, key):
+		with self._lock:
+			old = self._items.pop(key, None)
+			if old is not None:
+				self.nbytes -= old.nbytes
 
 class Slice(object):
-	def __init__(self, filename, num):
-		self.filename = filename,
+	def __init__(self, filename, num, cache=False, pixels=None, lazy=False):
+		'''With lazy, only the dimensions of the slice file are read now, and 
+		the pixels when they are first needed.'''
+		self.filename = filename
 		self.num = num
-		self.pixels = self._readSliceFile(filename)
-		self.shape = self.pixels.shape
-	
-	def _readSliceFile(self, filename):
-		pixel_data = []
-		with open(filename) as file:
-			for line in file:
-				row = line.strip().split(' ')
-				row = [float(p) for p in row]
-				pixel_data.append(row)
-		return np.array(pixel_data)
+		self.cache = cache
+		# set when the slice belongs to an Image, which then holds the pixels
+		self.image = None
+		self.index = None
+		if lazy:
+			self._pixels = None
+			self.shape = probeSliceShape(filename)
+		else:
+			if pixels is None:
+				pixels = self._readSliceFile(filename, cache)
+			self._pixels = pixels
+			self.shape = pixels.shape
+	
+	@property
+	def pixels(self):
+		if self.image is not None:
+			return self.image._getPixels(self)
+		if self._pixels is None:
+			self._pixels = self._readSliceFile(self.filename, self.cache)
+		return self._pixels
+	
+	@pixels.setter
+	def pixels(self, pixels):
+		if self.image is not None:
+			self.image._setPixels(self, pixels)
+		else:
+			self._pixels = pixels
+	
+	def load(self):
+		'''Read the pixels from the slice file.'''
+		return self._readSliceFile(self.filename, self.cache)
+	
+	def _readSliceFile(self, filename, cache=False):
+		'''Read the slice text file. With cache, a binary .npy copy is kept 
+		next to it and used (memory-mapped) instead of parsing the text again.'''
+		if cache:
+			pixels = readSliceCache(filename)
+			if pixels is not None:
+				return pixels
+		pixels = readSliceText(filename)
+		if cache:
+			writeSliceCache(filename, pixels)
+		return pixels
 	
 	def plot(self, regions=None, window=None, level=None):
 		'''Plot the slice.
 		Accepts a region or list of regions, and window and level options.
 		Returns a matplotlib figure that can then be displayed or saved.
+		(pct.render.renderSlice saves the same plot without pyplot.)
 		'''
 		fig = plot.figure()
-		ax = fig.add_subplot(1, 1, 1)
-		imgplot = plot.imshow(self.pixels, cmap='gray', interpolation='nearest')
-		plot.xlabel('x (pixel)')
-		plot.ylabel('y (pixel)')
-		cbar = plot.colorbar()
-		cbar.set_label('RSP')
-		
-		if window != None and level != None:
-			imgplot.set_clim(level - window/2, level + window/2)
-		
-		if regions:
-			colors = ['blue', 'green', 'red', 'cyan', 'magenta', 'yellow', 'black', 'white']
-			i = 0
-			
-			if not iterable(regions):
-				if isinstance(regions, pctroi.ROI):
-					regions = [regions]
-				else:
-					raise ValueError('region is not a valid ROI object')
-			
-			for roi in regions:
-				patch = roi.getOverlayPatch(colors[i])
-				if patch: ax.add_patch(patch)
-				i += 1
-				if i >= len(colors): i = 0
-			plot.legend()
-		
+		pctrender.drawSlice(fig, self.pixels, regions, window, level)
 		return fig
 	
+# default size of the slice cache of lazy images
+default_cache_bytes = 256 * 1024**2
+
 class Image(object):
-	def __init__(self, iteration=None):
+	'''A stack of slices, stored as one (slice, y, x) array.
+	The pixels of each Slice are views into that array, which is available 
+	for whole-volume operations as Image.volume.
+	
+	A lazy image only reads slice files when their pixels are used, and 
+	keeps the most recently used ones in a cache of up to cache_bytes. 
+	Pixels assigned to its slices are kept outside of the cache, so they 
+	are never replaced by the file contents. With prefetch, that many 
+	neighbouring slices on each side of a used slice are loaded in the 
+	background, as long as they fit in the cache without evicting others.
+	'''
+	
+	def __init__(self, iteration=None, capacity=None, lazy=False, cache_bytes=default_cache_bytes, prefetch=0):
+		'''capacity: number of slices to preallocate space for'''
 		self.slices = []
 		self.shape = None
 		self.iteration = iteration
+		self.capacity = capacity
+		self.lazy = lazy
+		self.prefetch = prefetch
+		self._volume = None
+		self._slice_index = {}
+		self._cache = SliceCache(cache_bytes) if lazy else None
+		# index -> pixels assigned to the slices of a lazy image
+		self._assigned = {}
+		self._prefetch_pool = None
+		self._prefetching = set()
+	
+	@classmethod
+	def fromVolume(cls, volume, slicenums=None, iteration=None):
+		'''Wrap an existing (slice, y, x) array or memmap, without copying it.'''
+		image = cls(iteration)
+		image.shape = volume.shape[1:]
+		image._volume = volume
+		if slicenums is None:
+			slicenums = range(len(volume))
+		for index, slicenum in enumerate(slicenums):
+			image._attachSlice(Slice(None, slicenum, pixels=volume[index]))
+		return image
 	
-	def addSlice(self, filename, slicenum=None):
-		slice = Slice(filename, slicenum)
+	@property
+	def volume(self):
+		'''The (slice, y, x) pixel array. For a lazy image this reads every 
+		slice into a new array.'''
+		if self.lazy:
+			if not self.slices:
+				return None
+			return np.array([slice.pixels for slice in self.slices])
+		if self._volume is None:
+			return None
+		return self._volume[:len(self.slices)]
+	
+	def addSlice(self, filename, slicenum=None, cache=False):
+		slice = Slice(filename, slicenum, cache, lazy=self.lazy)
 		if self.shape is None:
 			self.shape = slice.shape
 		elif self.shape != slice.shape:
 			raise Exception("Dimensions of slices in image do not match!")
+		
+		if not self.lazy:
+			num_slices = len(self.slices)
+			if self._volume is None or num_slices == len(self._volume):
+				self._grow(max(self.capacity or 0, 2 * num_slices, 1))
+			self._volume[num_slices] = slice.pixels
+			slice._pixels = None
+		self._attachSlice(slice)
+	
+	def _getPixels(self, slice):
+		if not self.lazy:
+			return self._volume[slice.index]
+		if slice.index in self._assigned:
+			return self._assigned[slice.index]
+		pixels = self._cache.get(slice.index)
+		if pixels is None:
+			pixels = slice.load()
+			if pixels.shape != self.shape:
+				raise Exception("Dimensions of slices in image do not match!")
+			self._cache.put(slice.index, pixels)
+		if self.prefetch:
+			self._prefetchAround(slice.index)
+		return pixels
+	
+	def _setPixels(self, slice, pixels):
+		if self.lazy:
+			self._assigned[slice.index] = np.array(pixels, dtype=float).reshape(self.shape)
+			self._cache.discard(slice.index)
+		else:
+			self._volume[slice.index] = pixels
+	
+	def _prefetchAround(self, index):
+		if self._prefetch_pool is None:
+			self._prefetch_pool = multiprocessing.pool.ThreadPool(1)
+		first = max(index - self.prefetch, 0)
+		last = min(index + self.prefetch, len(self.slices) - 1)
+		for neighbour in range(first, last + 1):
+			if neighbour not in self._cache and neighbour not in self._assigned and neighbour not in self._prefetching:
+				self._prefetching.add(neighbour)
+				self._prefetch_pool.apply_async(self._prefetchSlice, (neighbour,))
+	
+	def _prefetchSlice(self, index):
+		try:
+			slice_bytes = 8 * self.shape[0] * self.shape[1]
+			if index not in self._cache and self._cache.nbytes + slice_bytes <= self._cache.max_bytes:
+				pixels = self.slices[index].load()
+				# a slice of the wrong size is reported when it is used
+				if pixels.shape == self.shape:
+					self._cache.put(index, pixels, cold=True)
+		finally:
+			self._prefetching.discard(index)
+	
+	def _grow(self, capacity):
+		volume = np.empty((capacity,) + self.shape)
+		if self._volume is not None:
+			volume[:len(self.slices)] = self._volume[:len(self.slices)]
+		self._volume = volume
+	
+	def _attachSlice(self, slice):
+		slice.image = self
+		slice.index = len(self.slices)
 		self.slices.append(slice)
+		# like list.index, the first slice with a number wins
+		self._slice_index.setdefault(slice.num, slice.index)
 	
 	def plotSlice(self, slicenum, regions=None, window=None, level=None):
 		return self.getSlice(slicenum).plot(regions, window, level)
 	
 	def getSlice(self, slicenum):
-		slicenums = [slice.num for slice in self.slices]
 		try:
-			sliceindex = slicenums.index(slicenum)
-		except ValueError:
+			sliceindex = self._slice_index[slicenum]
+		except KeyError:
 			raise ValueError('Slice %d is not in image.' % slicenum)
 		return self.slices[sliceindex]
@@ -0,0 +1,196 @@
+"""
+Timing, counting and progress reporting for long running conversions.
+
+Code being measured marks its stages and counts what it processes through
+the module functions (stage, count, log, progress), which go to the current
+Recorder. A Recorder accumulates the time spent in each stage, counters
+(events, bytes, files...) and prints messages up to its verbosity:
+
+    0: nothing
+    1: one line per file, and summaries (the default)
+    2: everything, e.g. file headers and every slice loaded
+
+Stages can be nested; the time of a stage does not include the time of the
+stages inside it, so the stage times add up to the total measured time.
+
+Worker threads record directly into the current Recorder, which is thread
+safe. Worker processes record into their own Recorder (see
+recordSeparately), whose report is merged into the parent's with
+Recorder.merge.
+
+================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import json
+import time
+import threading
+import contextlib
+
+class Recorder(object):
+    '''
+    Accumulates stage times and counters, and prints messages.
+    verbosity: 0 (quiet), 1 (default) or 2 (detailed)
+    progress: optional function called as progress(stage, done, total)
+    stream: where messages are printed (default is sys.stdout)
+    '''
+
+    def __init__(self, verbosity=1, progress=None, stream=None):
+        self.verbosity = verbosity
+        self.progress_callback = progress
+        self.stream = stream
+        self.stages = {}
+        self.counters = {}
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enabled(self, level=1):
+        '''Whether messages at level are printed.'''
+        return self.verbosity >= level
+
+    def log(self, message='', level=1):
+        if self.verbosity >= level:
+            stream = self.stream or sys.stdout
+            stream.write('%s\n' % message)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _addTime(self, name, seconds, calls):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Context manager timing the code inside it as stage name.'''
+        stack = self._stack()
+        now = time.time()
+        if stack:
+            # pause the enclosing stage
+            parent = stack[-1]
+            self._addTime(parent[0], now - parent[1], 0)
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            entry = stack.pop()
+            self._addTime(name, now - entry[1], 1)
+            if stack:
+                stack[-1][1] = now
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def progress(self, stage, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(stage, done, total)
+
+    def report(self):
+        '''The recorded times and counters as a dict (suitable for JSON).'''
+        with self._lock:
+            stages = dict((name, {'seconds': seconds, 'calls': calls}) for name, (seconds, calls) in self.stages.items())
+            counters = dict(self.counters)
+        wall_seconds = time.time() - self.start_time
+        report = {'stages': stages, 'counters': counters, 'wall_seconds': wall_seconds}
+        if wall_seconds > 0:
+            report['throughput'] = dict(('%s_per_second' % name, value / wall_seconds) for name, value in counters.items())
+        return report
+
+    def merge(self, report):
+        '''Add the stage times and counters of a report (e.g. from a worker process).'''
+        for name, stage in report['stages'].items():
+            self._addTime(name, stage['seconds'], stage['calls'])
+        for name, value in report['counters'].items():
+            self.count(name, value)
+
+    def writeReport(self, filename):
+        '''Write the report to filename as JSON.'''
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def printSummary(self, level=1):
+        '''Print the time spent in each stage, slowest first, and the counters.'''
+        if self.verbosity < level:
+            return
+        report = self.report()
+        total = sum(stage['seconds'] for stage in report['stages'].values())
+        stages = sorted(report['stages'].items(), key=lambda item: -item[1]['seconds'])
+        for name, stage in stages:
+            share = 100 * stage['seconds'] / total if total > 0 else 0
+            self.log('%-12s %10.3f s %5.1f%% %8d calls' % (name, stage['seconds'], share, stage['calls']), level)
+        for name in sorted(report['counters']):
+            rate = report.get('throughput', {}).get('%s_per_second' % name)
+            self.log('%-12s %14d %s' % (name, report['counters'][name], '(%.0f/s)' % rate if rate else ''), level)
+
+# the Recorder the module functions report to
+_current = Recorder()
+
+def current():
+    return _current
+
+def configure(verbosity=1, progress=None, stream=None):
+    '''Replace the current Recorder with a new one, which is returned.'''
+    global _current
+    _current = Recorder(verbosity, progress, stream)
+    return _current
+
+@contextlib.contextmanager
+def recording(recorder):
+    '''Context manager making recorder the current Recorder inside it.'''
+    global _current
+    previous = _current
+    _current = recorder
+    try:
+        yield recorder
+    finally:
+        _current = previous
+
+def recordSeparately(function, args=(), verbosity=None):
+    '''
+    Call function(*args) with a new Recorder as the current one (with the
+    verbosity of the current one by default), e.g. in a worker process.
+    Returns the result and the report of the new Recorder.
+    '''
+    if verbosity is None:
+        verbosity = _current.verbosity
+    with recording(Recorder(verbosity)) as recorder:
+        result = function(*args)
+    return result, recorder.report()
+
+def enabled(level=1):
+    return _current.enabled(level)
+
+def log(message='', level=1):
+    _current.log(message, level)
+
+def stage(name):
+    return _current.stage(name)
+
+def count(name, amount=1):
+    _current.count(name, amount)
+
+def progress(stage, done, total):
+    _current.progress(stage, done, total)
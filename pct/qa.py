@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+qa.py
+
+Quality assurance summaries of pCT scan data.
+
+Every projection file of a scan is read one chunk at a time, and for each
+projection angle the events are binned on a (t, v) grid: by their position
+at u = 0 for the WEPL count, mean and variance maps, and by their position
+on the front (entry) and rear (exit) tracker planes for the coverage
+histograms. Files can be processed by a pool of worker processes; their
+results are merged in file name order, so they are identical to those of a
+single process. The summary is saved as one compressed .npz file.
+
+==============
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import time
+import multiprocessing
+
+import numpy as np
+
+import dataconvert
+import instrument
+
+# maps of each angle, stored as one (num_maps, num_bins) array
+map_names = ('count', 'mean', 'squares', 'entry', 'exit')
+COUNT, MEAN, SQUARES, ENTRY, EXIT = range(len(map_names))
+
+def combineMaps(a, b):
+    '''
+    Combine the maps of two sets of events (see dataconvert.combineStatistics
+    for the means and sums of squared deviations). Returns a new array.
+    '''
+    result = a + b
+    result[COUNT], result[MEAN], result[SQUARES] = dataconvert.combineStatistics(
+        a[COUNT], a[MEAN], a[SQUARES], b[COUNT], b[MEAN], b[SQUARES])
+    return result
+
+class ScanQA(object):
+    '''
+    Per-angle binned WEPL statistics and tracker coverage of a scan.
+    
+    t_range, v_range: (min, max) extent (mm) of the grid
+    bin_size: size (mm) of the square bins
+    
+    Events outside of the grid are not counted. The maps of each angle take
+    5 * 8 bytes per bin, and do not grow with the number of events.
+    '''
+    
+    def __init__(self, t_range=(-180.0, 180.0), v_range=(-50.0, 50.0), bin_size=2.0):
+        self.t_range = tuple(float(x) for x in t_range)
+        self.v_range = tuple(float(x) for x in v_range)
+        self.bin_size = float(bin_size)
+        self.shape = (int(np.ceil((self.t_range[1] - self.t_range[0]) / self.bin_size)),
+                      int(np.ceil((self.v_range[1] - self.v_range[0]) / self.bin_size)))
+        if min(self.shape) < 1:
+            raise ValueError('The t and v ranges must not be empty')
+        # angle -> (num_maps, num_bins) array
+        self.maps = {}
+    
+    def _binIndex(self, t, v):
+        '''Flat bin index of each (t, v) position, and a mask of those inside the grid.'''
+        t_bin = np.floor((t - self.t_range[0]) / self.bin_size).astype(np.int64)
+        v_bin = np.floor((v - self.v_range[0]) / self.bin_size).astype(np.int64)
+        inside = (t_bin >= 0) & (t_bin < self.shape[0]) & (v_bin >= 0) & (v_bin < self.shape[1])
+        return t_bin[inside] * self.shape[1] + v_bin[inside], inside
+    
+    def _newMaps(self):
+        return np.zeros((len(map_names), self.shape[0] * self.shape[1]))
+    
+    def addChunk(self, chunk):
+        '''Add the events of a chunk (from dataconvert.iterChunks) to the maps of its angle.'''
+        num_bins = self.shape[0] * self.shape[1]
+        maps = self._newMaps()
+        
+        t, v = dataconvert.isocenterPosition(chunk)
+        index, inside = self._binIndex(t, v)
+        wepl = chunk.wepl[inside].astype(float)
+        counts = np.bincount(index, minlength=num_bins).astype(float)
+        maps[COUNT] = counts
+        maps[MEAN] = np.bincount(index, wepl, minlength=num_bins) / np.maximum(counts, 1)
+        maps[SQUARES] = np.bincount(index, (wepl - maps[MEAN][index])**2, minlength=num_bins)
+        
+        for plane, name in ((0, ENTRY), (3, EXIT)):
+            index, inside = self._binIndex(chunk.t[plane], chunk.v[plane])
+            maps[name] = np.bincount(index, minlength=num_bins)
+        
+        angle = float(chunk.projection_angle)
+        if angle in self.maps:
+            self.maps[angle] = combineMaps(self.maps[angle], maps)
+        else:
+            self.maps[angle] = maps
+    
+    def addData(self, data, chunk_size=dataconvert.default_chunk_size):
+        '''Add all events of a projection (e.g. from dataconvert.readFile), one chunk at a time.'''
+        for chunk in dataconvert.iterChunks(data, chunk_size):
+            with instrument.stage('qa'):
+                self.addChunk(chunk)
+    
+    def merge(self, other):
+        '''Add the maps of another ScanQA with the same grid.'''
+        if (other.t_range, other.v_range, other.bin_size) != (self.t_range, self.v_range, self.bin_size):
+            raise ValueError('Cannot merge QA summaries with different grids')
+        for angle in sorted(other.maps):
+            if angle in self.maps:
+                self.maps[angle] = combineMaps(self.maps[angle], other.maps[angle])
+            else:
+                self.maps[angle] = other.maps[angle].copy()
+    
+    @property
+    def angles(self):
+        return np.array(sorted(self.maps))
+    
+    def getMap(self, name):
+        '''One of map_names for all angles, as an (angle, t, v) array.'''
+        i = map_names.index(name)
+        shape = (len(self.maps),) + self.shape
+        if not self.maps:
+            return np.zeros(shape)
+        return np.array([self.maps[angle][i] for angle in sorted(self.maps)]).reshape(shape)
+    
+    def counts(self):
+        return self.getMap('count')
+    
+    def means(self):
+        '''Mean WEPL of each bin (0 in empty bins).'''
+        return self.getMap('mean')
+    
+    def variances(self):
+        '''Variance of the WEPL of each bin (0 in empty bins).'''
+        return self.getMap('squares') / np.maximum(self.counts(), 1)
+    
+    def entryCoverage(self):
+        '''Number of events crossing each bin of the front tracker plane.'''
+        return self.getMap('entry')
+    
+    def exitCoverage(self):
+        '''Number of events crossing each bin of the rear tracker plane.'''
+        return self.getMap('exit')
+    
+    def sinogram(self, v_range=None):
+        '''
+        Mean WEPL of each (angle, t) bin, over the v bins inside v_range
+        (default is all of them). Returns an (angle, t) array.
+        '''
+        counts = self.counts()
+        sums = self.means() * counts
+        if v_range is not None:
+            centers = self.v_range[0] + self.bin_size * (np.arange(self.shape[1]) + 0.5)
+            keep = (centers >= v_range[0]) & (centers <= v_range[1])
+            counts, sums = counts[:, :, keep], sums[:, :, keep]
+        return sums.sum(axis=2) / np.maximum(counts.sum(axis=2), 1)
+    
+    def save(self, filename):
+        '''Save the summary as a compressed .npz file.'''
+        np.savez_compressed(filename, angles=self.angles,
+                            t_range=self.t_range, v_range=self.v_range, bin_size=self.bin_size,
+                            **dict((name, self.getMap(name)) for name in map_names))
+    
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            qa = cls(f['t_range'], f['v_range'], f['bin_size'])
+            maps = np.array([f[name] for name in map_names])
+            for i, angle in enumerate(f['angles']):
+                qa.maps[float(angle)] = maps[:, i].reshape(len(map_names), -1)
+        return qa
+
+def analyzeFile(filename, t_range=(-180.0, 180.0), v_range=(-50.0, 50.0), bin_size=2.0,
+                chunk_size=dataconvert.default_chunk_size):
+    '''Returns the ScanQA of one projection file.'''
+    qa = ScanQA(t_range, v_range, bin_size)
+    qa.addData(dataconvert.readFile(filename), chunk_size)
+    return qa
+
+def _analyzeFileJob(job):
+    '''
+    Run analyzeFile in a worker process, recording its times and counters
+    separately. Returns (ScanQA, report).
+    '''
+    filename, options = job
+    return instrument.recordSeparately(lambda: analyzeFile(filename, **options))
+
+def analyzeFiles(filelist, jobs=1, **options):
+    '''
+    Analyze the files in a list, using a pool of jobs processes, and merge
+    the results in order of file name. Returns one ScanQA.
+    options are passed on to analyzeFile.
+    '''
+    filelist = sorted(filelist)
+    qa = ScanQA(**dict((name, options[name]) for name in ('t_range', 'v_range', 'bin_size') if name in options))
+    if jobs == 1:
+        for done, filename in enumerate(filelist, 1):
+            qa.merge(analyzeFile(filename, **options))
+            instrument.progress('files', done, len(filelist))
+        return qa
+    
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # imap returns the results in order, so the merge is deterministic
+        job_list = [(filename, options) for filename in filelist]
+        for done, (file_qa, report) in enumerate(pool.imap(_analyzeFileJob, job_list), 1):
+            qa.merge(file_qa)
+            instrument.current().merge(report)
+            instrument.progress('files', done, len(filelist))
+    finally:
+        pool.close()
+        pool.join()
+    return qa
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the WEPL and tracker coverage of a pCT scan')
+    parser.add_argument('--t-range', type=float, nargs=2, default=(-180.0, 180.0), metavar=('MIN', 'MAX'), help='Extent of the t bins in mm (default is %(default)s)')
+    parser.add_argument('--v-range', type=float, nargs=2, default=(-50.0, 50.0), metavar=('MIN', 'MAX'), help='Extent of the v bins in mm (default is %(default)s)')
+    parser.add_argument('--bin-size', type=float, default=2.0, help='Size of the (t, v) bins in mm (default is %(default)g)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=dataconvert.default_chunk_size, help='Number of histories to read at a time (default is %(default)d)')
+    parser.add_argument('-i', '--input-type', choices=sorted(dataconvert.input_types) + ['all'], help='Type of input files to read (required if the input directory contains more than one type)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to read in parallel (default is %(default)d)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only print errors')
+    parser.add_argument('--report', metavar='FILE', help='Write the stage times and counters of the run to FILE as JSON')
+    parser.add_argument('inputdir', help='Input directory')
+    parser.add_argument('output', help='Output .npz file')
+    
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    instrument.configure(verbosity=0 if args.quiet else 1)
+    
+    try:
+        filelist = dataconvert.findInputFiles(args.inputdir, args.input_type)
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.time()
+    qa = analyzeFiles(filelist, args.jobs, t_range=args.t_range, v_range=args.v_range,
+                      bin_size=args.bin_size, chunk_size=args.chunk_size)
+    qa.save(args.output)
+    
+    instrument.log('Projection angles: %d' % len(qa.maps))
+    instrument.log('Events binned: %d' % qa.counts().sum())
+    instrument.log('Wall time: %.2f s' % (time.time() - start))
+    instrument.current().printSummary()
+    if args.report:
+        instrument.current().writeReport(args.report)
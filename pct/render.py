@@ -0,0 +1,164 @@
+"""
+Headless rendering of slices and ROI plots to image files.
+
+Figures are created directly as matplotlib Figure objects on an Agg canvas,
+without pyplot, so they are not kept alive by pyplot's global list of open
+figures and each one is released as soon as it has been saved. The draw*
+functions are also used by Slice.plot and the ROI plot methods, which
+return pyplot figures for interactive use.
+
+renderBatch spreads a list of rendering jobs over a pool of processes:
+
+    jobs = [('slice', (filename, pixels, regions)),
+            ('radial_profile', (filename, circle, pixels)),
+            ('line_profile', (filename, rectangle, pixels), {'axis': 1})]
+    render.renderBatch(jobs)
+
+=================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import multiprocessing
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# colors of the overlaid regions, in order
+region_colors = ['blue', 'green', 'red', 'cyan', 'magenta', 'yellow', 'black', 'white']
+
+def newFigure(figsize=None, dpi=None):
+    '''A Figure attached to its own Agg canvas, not managed by pyplot.'''
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+def saveFigure(fig, filename, dpi=None):
+    '''Save fig to filename and release its contents.'''
+    try:
+        fig.savefig(filename, dpi=dpi)
+    finally:
+        fig.clf()
+
+def drawSlice(fig, pixels, regions=None, window=None, level=None):
+    '''
+    Draw the pixels of a slice on fig, with a colorbar and optional
+    overlaid regions (an ROI or list of ROIs), window and level.
+    '''
+    ax = fig.add_subplot(1, 1, 1)
+    imgplot = ax.imshow(pixels, cmap='gray', interpolation='nearest')
+    ax.set_xlabel('x (pixel)')
+    ax.set_ylabel('y (pixel)')
+    cbar = fig.colorbar(imgplot, ax=ax)
+    cbar.set_label('RSP')
+    
+    if window is not None and level is not None:
+        imgplot.set_clim(level - window/2, level + window/2)
+    
+    if regions:
+        if hasattr(regions, 'getOverlayPatch'):
+            regions = [regions]
+        elif not isinstance(regions, collections.Iterable):
+            raise ValueError('region is not a valid ROI object')
+        
+        for i, roi in enumerate(regions):
+            patch = roi.getOverlayPatch(region_colors[i % len(region_colors)])
+            if patch: ax.add_patch(patch)
+        ax.legend()
+    return ax
+
+def drawProfile(fig, points, values, title, xlabel):
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(points, values)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel('RSP')
+    return ax
+
+def drawRadialProfile(fig, roi, pixels):
+    points, values = roi.getRadialProfile(pixels)
+    return drawProfile(fig, points, values, roi.name + ' - Radial Profile', 'r (pixel)')
+
+def drawLineProfile(fig, roi, pixels, axis=0):
+    points, values = roi.getLineProfile(pixels, axis)
+    return drawProfile(fig, points, values, roi.name + ' - Line Profile', roi.getProfileLabel(axis))
+
+def renderSlice(filename, pixels, regions=None, window=None, level=None, dpi=None):
+    '''Save a plot of a slice (see drawSlice) to filename.'''
+    fig = newFigure(dpi=dpi)
+    drawSlice(fig, pixels, regions, window, level)
+    saveFigure(fig, filename)
+    return filename
+
+def renderRadialProfile(filename, roi, pixels, dpi=None):
+    '''Save the radial profile of a CircleROI to filename.'''
+    fig = newFigure(dpi=dpi)
+    drawRadialProfile(fig, roi, pixels)
+    saveFigure(fig, filename)
+    return filename
+
+def renderLineProfile(filename, roi, pixels, axis=0, dpi=None):
+    '''Save the line profile of a RectangleROI to filename.'''
+    fig = newFigure(dpi=dpi)
+    drawLineProfile(fig, roi, pixels, axis)
+    saveFigure(fig, filename)
+    return filename
+
+# job kinds of renderBatch
+renderers = {'slice': renderSlice,
+             'radial_profile': renderRadialProfile,
+             'line_profile': renderLineProfile}
+
+def renderJob(job):
+    '''Run one (kind, args) or (kind, args, kwargs) job. Returns the filename.'''
+    kind, args = job[:2]
+    kwargs = job[2] if len(job) > 2 else {}
+    return renderers[kind](*args, **kwargs)
+
+def renderBatch(jobs, processes=None, max_pending=None, tasks_per_process=100):
+    '''
+    Render an iterable of jobs (see renderJob) with a pool of processes
+    (default is one per core; 1 renders in this process).
+    Jobs are only taken from the iterable as the workers become free (at
+    most max_pending at a time, default is twice the number of processes),
+    so a generator of jobs is rendered in constant memory. Workers are
+    replaced after tasks_per_process jobs.
+    Returns the list of filenames written, in the order of the jobs.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1:
+        return [renderJob(job) for job in jobs]
+    
+    max_pending = max_pending or 2 * processes
+    pool = multiprocessing.Pool(processes, maxtasksperchild=tasks_per_process)
+    filenames = []
+    pending = collections.deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(renderJob, (job,)))
+            if len(pending) >= max_pending:
+                filenames.append(pending.popleft().get())
+        while pending:
+            filenames.append(pending.popleft().get())
+    finally:
+        # only left pending if a job failed
+        if pending:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+    return filenames
@@ -3,12 +3,21 @@ Region of interest objects.
 
 A region of interest (ROI) is a geometric area of an image that should 
 be analyzed. Most of the work is done by creating "array masks" that can 
-be applied to images (numpy arrays) to select only specific pixels.
+be applied to images (numpy arrays) to select only specific pixels. Each 
+ROI keeps only the mask of its bounding box (local_mask, placed in the 
+image by the bbox slices), so its memory use and measurement cost depend 
+on its own size and not on the size of the image. The full-image mask is 
+still available as ROI.mask.
 
-More types of regions need to be added (e.g., rotated rectangle) along 
-with more analysis methods. If many analysis methods are added, it may 
-make more sense to move those out of the ROI objects to keep them from 
-getting too cluttered.
+Besides circles and rectangles, arbitrary polygons (PolygonROI) and 
+rotated rectangles (RotatedRectangleROI) are supported, optionally with 
+pixels weighted by the fraction of their area inside the region. 
+Volumetric ROIs (SphereROI, CylinderROI and BoxROI) work the same way on 
+(slice, y, x) volumes.
+
+More analysis methods need to be added. If many analysis methods are 
+added, it may make more sense to move those out of the ROI objects to 
+keep them from getting too cluttered.
 
 =================
 
@@ -31,44 +40,158 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy as np
 import matplotlib.pyplot as plot
 import matplotlib as mpl
+import render as pctrender
 from math import sqrt
 
+def clippedSlice(start, stop, *limits):
+	'''Slice covering start to stop, clipped to 0 and to each of the limits.'''
+	start = max(start, 0)
+	stop = max(min((stop,) + limits), start)
+	return slice(start, stop)
+
+def cropMask(mask):
+	'''Bounding box (tuple of slices) of the True values of a full mask, 
+	and the mask cropped to it.'''
+	mask = np.asarray(mask, dtype=bool)
+	bbox = []
+	for axis in range(mask.ndim):
+		other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+		used = np.flatnonzero(mask.any(axis=other_axes))
+		bbox.append(slice(used[0], used[-1] + 1) if len(used) else slice(0, 0))
+	bbox = tuple(bbox)
+	return bbox, mask[bbox].copy()
+
+def diskMask(x, y, r, rows, columns):
+	'''Mask of the pixels within distance r of (x, y), over the given row 
+	and column slices.'''
+	dy = np.arange(rows.start, rows.stop)[:, np.newaxis] - y
+	dx = np.arange(columns.start, columns.stop)[np.newaxis, :] - x
+	return dx**2 + dy**2 <= r**2
+
+def polygonMask(vertices, rows, columns, supersample=1):
+	'''Which pixels (over the given row and column slices) have their center 
+	inside the polygon (even-odd rule). With supersample, the fraction of 
+	supersample x supersample points of each pixel that are inside.
+	Scanline fill: each edge toggles the points to the left of where it 
+	crosses their row, which is marked at the two ends of that run for all 
+	rows at once, and a cumulative sum along the rows fills the runs in.'''
+	n = supersample
+	offsets = (np.arange(n) + 0.5) / n - 0.5
+	y = (np.arange(rows.start, rows.stop)[:, np.newaxis] + offsets).ravel()
+	x = (np.arange(columns.start, columns.stop)[:, np.newaxis] + offsets).ravel()
+	toggles = np.zeros((len(y), len(x) + 1), np.uint8)
+	vx, vy = np.array(vertices, dtype=float).T
+	for x1, y1, x2, y2 in zip(vx, vy, np.roll(vx, -1), np.roll(vy, -1)):
+		crosses = np.flatnonzero((y1 > y) != (y2 > y))
+		if len(crosses) == 0:
+			continue
+		x_cross = x1 + (y[crosses] - y1) * (x2 - x1) / (y2 - y1)
+		# points with x < x_cross are toggled
+		toggles[crosses, 0] ^= 1
+		toggles[crosses, np.searchsorted(x, x_cross)] ^= 1
+	inside = np.bitwise_xor.accumulate(toggles[:, :-1], axis=1)
+	if n == 1:
+		return inside.view(bool)
+	counts = inside.reshape(len(y) // n, n, len(x) // n, n).sum(axis=3, dtype=np.int32).sum(axis=1)
+	return counts / float(n * n)
+
+def bilinearSample(pixels, x, y):
+	'''Values of pixels at (x, y) positions (column, row), interpolated 
+	bilinearly. Positions outside of the image give NaN.'''
+	x = np.asarray(x, dtype=float)
+	y = np.asarray(y, dtype=float)
+	rows, columns = pixels.shape
+	outside = (x < 0) | (x > columns - 1) | (y < 0) | (y > rows - 1)
+	x0 = np.clip(np.floor(x).astype(int), 0, max(columns - 2, 0))
+	y0 = np.clip(np.floor(y).astype(int), 0, max(rows - 2, 0))
+	x1 = np.minimum(x0 + 1, columns - 1)
+	y1 = np.minimum(y0 + 1, rows - 1)
+	fx = np.clip(x - x0, 0, 1)
+	fy = np.clip(y - y0, 0, 1)
+	values = ((pixels[y0, x0] * (1 - fx) + pixels[y0, x1] * fx) * (1 - fy) + 
+		(pixels[y1, x0] * (1 - fx) + pixels[y1, x1] * fx) * fy)
+	values[outside] = np.nan
+	return values
+
 class ROI(object):
-	'''Generic ROI'''
+	'''Generic ROI
+	Subclasses implement makeLocalMask, which returns the bounding box of 
+	the ROI in the image (a tuple of slices) and the mask of the ROI 
+	within it.
+	'''
+	
+	# number of dimensions of the images the ROI applies to
+	ndim = 2
 	
 	def __init__(self, name, location, size, imageshape):
 		self.name = name
 		self.location = location
 		self.size = size
 		self.imageshape = imageshape
-		self.mask = None
+		self.bbox = None
+		self.local_mask = None
+	
+	@property
+	def mask(self):
+		'''Full image mask, made from the local mask when it is used.'''
+		return self.makeArrayMask()
+	
+	@mask.setter
+	def mask(self, mask):
+		if mask is None:
+			self.bbox, self.local_mask = None, None
+		else:
+			self.bbox, self.local_mask = cropMask(mask)
+	
+	def getLocalMask(self):
+		'''Returns the bounding box slices and the local mask.'''
+		if self.local_mask is None:
+			self.bbox, self.local_mask = self.makeLocalMask()
+		return self.bbox, self.local_mask
+	
+	def getPixelCoordinates(self):
+		'''Image indices (rows, columns) of the pixels of the ROI, in the 
+		same (row major) order as np.nonzero(mask).'''
+		bbox, local_mask = self.getLocalMask()
+		return tuple(indices + s.start for indices, s in zip(np.nonzero(local_mask), bbox))
+	
+	def flatIndices(self):
+		'''Indices of the pixels of the ROI in a flattened image.'''
+		return np.ravel_multi_index(self.getPixelCoordinates(), self.imageshape)
+	
+	def getPixelWeights(self):
+		'''Weight of each pixel of the ROI (in the order of flatIndices), or 
+		None if they all count fully.'''
+		return None
 	
 	def calculateArea(self):
-		if self.mask == None:
-			self.mask = self.makeArrayMask()
-		area = 0
-		for p in self.mask.flat:
-			if p: area += 1
-		return area
+		bbox, local_mask = self.getLocalMask()
+		return np.count_nonzero(local_mask)
+	
+	def getValues(self, pixel_array):
+		'''The values of the pixels of the ROI, from the bounding box only.'''
+		bbox, local_mask = self.getLocalMask()
+		return pixel_array[bbox][local_mask]
 	
 	def measure(self, pixel_array):
-		if self.mask == None:
-			self.mask = self.makeArrayMask()
-		mean = pixel_array[self.mask].mean()
-		sigma = pixel_array[self.mask].std()
-		return mean, sigma
+		values = self.getValues(pixel_array)
+		return values.mean(), values.std()
 	
 	def plotHistogram(self, pixel_array, bins=100):
-		if self.mask == None:
-			self.mask = self.makeArrayMask()
-		plot.hist(pixel_array[self.mask], histtype='step', bins=bins)
+		plot.hist(self.getValues(pixel_array), histtype='step', bins=bins)
 		plot.xlabel('RSP')
 		plot.title(self.name)
 		plot.show()
 	
-	def makeArrayMask(self):
+	def makeLocalMask(self):
 		raise NotImplementedError
 	
+	def makeArrayMask(self):
+		bbox, local_mask = self.getLocalMask()
+		mask = np.zeros(self.imageshape, bool)
+		mask[bbox] = local_mask
+		return mask
+	
 	def getOverlayPatch(self):
 		raise NotImplementedError
 
@@ -80,52 +203,71 @@ class CircleROI(ROI):
 	
 	def __init__(self, name, location, size, imageshape):
 		ROI.__init__(self, name, location, size, imageshape)
-		self.mask = self.makeArrayMask()
+		self.bbox, self.local_mask = self.makeLocalMask()
 		self.area = self.calculateArea()
 	
-	def makeArrayMask(self):
+	def makeLocalMask(self):
 		x, y = self.location
 		r = self.size
-		mask = np.zeros(self.imageshape, bool)
-		for row in range(y - r, y + r + 1):
-			if row >= 0 and row < self.imageshape[1]:
-				for column in range(x - r, x + r + 1):
-					if column >= 0 and column < self.imageshape[0]:
-						distance = (row - y)**2 + (column - x)**2
-						if distance <= r**2:
-							mask[row][column] = True
-		return mask
+		# rows are clipped to imageshape[1] and columns to imageshape[0]
+		rows = clippedSlice(y - r, y + r + 1, self.imageshape[1], self.imageshape[0])
+		columns = clippedSlice(x - r, x + r + 1, self.imageshape[0], self.imageshape[1])
+		return (rows, columns), diskMask(x, y, r, rows, columns)
 	
 	def getOverlayPatch(self, color='red'):
 		return mpl.patches.Circle(self.location, radius=self.size, facecolor='none', edgecolor=color, label=self.name)
 	
-	def getRadialProfile(self, pixels):
-		if self.mask == None:
-			self.mask = self.makeArrayMask()
-		values = []
+	def getRadialStatistics(self, pixels):
+		'''Mean, standard deviation and number of pixels of each ring in the ROI.
+		Ring r holds the pixels at a distance d from the center with 
+		max(r - 1, 0) <= d <= r, so pixels at an integer distance belong to 
+		two rings. pixels can be a single slice or a (slice, y, x) stack, 
+		which gives one profile per slice.
+		Returns points, means, sigmas, counts.
+		'''
 		points = range(self.size)
-		indices = np.indices(pixels.shape)
-		xs = indices[0][self.mask]
-		ys = indices[1][self.mask]
-		for r in points:
-			values_at_r = []
-			min_dist_sq = max(r - 1, 0)**2
-			max_dist_sq = r**2
-			for x, y in zip(xs, ys):
-				dist_sq = (x - self.location[0])**2 + (y - self.location[1])**2
-				if dist_sq <= max_dist_sq and dist_sq >= min_dist_sq:
-					values_at_r.append(pixels[x][y])
-			values.append(np.mean(values_at_r))
-		return points, values
+		rows, columns = self.getPixelCoordinates()
+		x, y = self.location
+		dist_sq = (columns - x)**2 + (rows - y)**2
+		
+		# ring of each pixel is ceil(sqrt(dist_sq)), corrected to be exact
+		ring = np.ceil(np.sqrt(dist_sq)).astype(int)
+		ring[(ring > 0) & ((ring - 1)**2 >= dist_sq)] -= 1
+		ring[ring**2 < dist_sq] += 1
+		on_edge = ring**2 == dist_sq
+		bins = np.concatenate((ring, ring[on_edge] + 1))
+		keep = bins < self.size
+		bins = bins[keep]
+		
+		values = pixels[..., rows, columns]
+		values = np.concatenate((values, values[..., on_edge]), axis=-1)[..., keep]
+		stack = np.atleast_2d(values)
+		num_slices = stack.shape[0]
+		index = (np.arange(num_slices)[:, np.newaxis] * self.size + bins).ravel()
+		length = num_slices * self.size
+		
+		counts = np.bincount(bins, minlength=self.size)
+		# bincount of no pixels at all gives integers, so divide by floats 
+		# to give NaN for the empty rings
+		divisor = counts.astype(float)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			sums = np.bincount(index, weights=stack.ravel(), minlength=length)
+			means = sums.reshape(num_slices, self.size) / divisor
+			deviations = stack - means[:, bins]
+			squares = np.bincount(index, weights=(deviations**2).ravel(), minlength=length)
+			sigmas = np.sqrt(squares.reshape(num_slices, self.size) / divisor)
+		
+		if values.ndim == 1:
+			means, sigmas = means[0], sigmas[0]
+		return points, means, sigmas, counts
+	
+	def getRadialProfile(self, pixels):
+		points, means, sigmas, counts = self.getRadialStatistics(pixels)
+		return points, means
 	
 	def plotRadialProfile(self, pixels):
-		points, values = self.getRadialProfile(pixels)
 		fig = plot.figure()
-		ax = fig.add_subplot(1, 1, 1)
-		plot.plot(points, values)
-		plot.title(self.name + ' - Radial Profile')
-		plot.xlabel('r (pixel)')
-		plot.ylabel('RSP')
+		pctrender.drawRadialProfile(fig, self, pixels)
 		return fig
 
 class RectangleROI(ROI):
@@ -136,38 +278,350 @@ class RectangleROI(ROI):
 	
 	def __init__(self, name, location, size, imageshape):
 		ROI.__init__(self, name, location, size, imageshape)
-		self.mask = self.makeArrayMask()
+		self.bbox, self.local_mask = self.makeLocalMask()
 		self.area = self.calculateArea()
 		
-	def makeArrayMask(self):
+	def getSlices(self):
+		'''Returns the (rows, columns) slices that select the rectangle from 
+		an image, so it can be taken as a view instead of with the mask.'''
 		x, y = self.location
 		w, h = self.size
-		mask = np.zeros(self.imageshape, bool)
-		for row in range(y, y + h):
-			if row >= 0 and row < self.imageshape[1]:
-				for column in range(x, x + w):
-					if column >= 0 and column < self.imageshape[0]:
-						mask[row][column] = True
-		return mask
+		rows = clippedSlice(y, y + h, self.imageshape[1], self.imageshape[0])
+		columns = clippedSlice(x, x + w, self.imageshape[0], self.imageshape[1])
+		return rows, columns
+	
+	def makeLocalMask(self):
+		rows, columns = self.getSlices()
+		return (rows, columns), np.ones((rows.stop - rows.start, columns.stop - columns.start), bool)
+	
+	def measure(self, pixel_array):
+		pixels = pixel_array[self.getSlices()]
+		return pixels.mean(), pixels.std()
 		
 	def getOverlayPatch(self, color='red'):
 		return mpl.patches.Rectangle(self.location, self.size[0], self.size[1], facecolor='none', edgecolor=color, label=self.name)
 	
 	def getLineProfile(self, pixels, axis=0):
-		if self.mask == None:
-			self.mask = self.makeArrayMask()
-		masked_pixels = pixels[self.mask]
-		masked_pixels.shape = self.size[::-1]
-		values = masked_pixels.mean(axis=axis)
+		values = pixels[self.getSlices()].mean(axis=axis)
 		points = range(self.location[axis], self.location[axis] + len(values))
 		return points, values
 	
+	def getProfileLabel(self, axis=0):
+		return 'x (pixel)' if axis == 0 else 'y (pixel)'
+	
 	def plotLineProfile(self, pixels, axis=0):
-		points, values = self.getLineProfile(pixels, axis)
 		fig = plot.figure()
-		ax = fig.add_subplot(1, 1, 1)
-		plot.plot(points, values)
-		plot.title(self.name + ' - Line Profile')
-		plot.xlabel('x (pixel)' if axis == 0 else 'y (pixel)')
-		plot.ylabel('RSP')
+		pctrender.drawLineProfile(fig, self, pixels, axis)
 		return fig
+
+class PolygonROI(ROI):
+	'''Polygonal ROI
+	vertices: list of (x, y) coordinates of its corners, in order
+	supersample: if given, each pixel is weighted by the fraction of it 
+		inside the polygon, estimated from supersample x supersample points; 
+		otherwise a pixel is inside if its center is
+	
+	The weights (in self.weights) are used by measure, area and measureRegions.
+	A polygon has no single location; its corners are in self.vertices.
+	'''
+	
+	def __init__(self, name, vertices, imageshape, supersample=None):
+		ROI.__init__(self, name, None, None, imageshape)
+		self.setVertices(vertices, supersample)
+	
+	def setVertices(self, vertices, supersample=None):
+		'''Set the corners, and make the mask and area.'''
+		self.vertices = [tuple(vertex) for vertex in vertices]
+		if len(self.vertices) < 3:
+			raise ValueError('A polygon needs at least three vertices')
+		self.supersample = supersample
+		self.weights = None
+		self.bbox, self.local_mask = self.makeLocalMask()
+		self.area = self.calculateArea()
+	
+	def makeLocalMask(self):
+		x, y = np.array(self.vertices, dtype=float).T
+		# with supersampling, a pixel is covered if any part of it is inside
+		margin = 0.5 if self.supersample else 0.0
+		rows = clippedSlice(int(np.ceil(y.min() - margin)), int(np.floor(y.max() + margin)) + 1, self.imageshape[0])
+		columns = clippedSlice(int(np.ceil(x.min() - margin)), int(np.floor(x.max() + margin)) + 1, self.imageshape[1])
+		inside = polygonMask(self.vertices, rows, columns, self.supersample or 1)
+		if self.supersample:
+			self.weights = inside
+			inside = inside > 0
+		return (rows, columns), inside
+	
+	def calculateArea(self):
+		if self.weights is not None:
+			return self.weights.sum()
+		return ROI.calculateArea(self)
+	
+	def getPixelWeights(self):
+		if self.weights is None:
+			return None
+		bbox, local_mask = self.getLocalMask()
+		return self.weights[local_mask]
+	
+	def measure(self, pixel_array):
+		if self.weights is None:
+			return ROI.measure(self, pixel_array)
+		bbox, local_mask = self.getLocalMask()
+		values = pixel_array[bbox][local_mask]
+		weights = self.weights[local_mask]
+		mean = np.average(values, weights=weights)
+		return mean, sqrt(np.average((values - mean)**2, weights=weights))
+	
+	def getOverlayPatch(self, color='red'):
+		return mpl.patches.Polygon(self.vertices, closed=True, facecolor='none', edgecolor=color, label=self.name)
+
+class RotatedRectangleROI(PolygonROI):
+	'''Rotated rectangular ROI
+	location: tuple of coordinates of its center (x, y)
+	size: tuple of dimensions (length, width)
+	angle: angle (degrees) of its long axis from the x axis towards the y axis
+	supersample: see PolygonROI
+	
+	Its corners are in self.vertices.
+	'''
+	
+	def __init__(self, name, location, size, angle, imageshape, supersample=None):
+		ROI.__init__(self, name, tuple(location), tuple(size), imageshape)
+		self.angle = angle
+		self.setVertices(self.getCorners(), supersample)
+	
+	def getAxes(self):
+		'''Unit vectors along the length and the width.'''
+		theta = np.radians(self.angle)
+		return np.array([np.cos(theta), np.sin(theta)]), np.array([-np.sin(theta), np.cos(theta)])
+	
+	def getCorners(self):
+		along, across = self.getAxes()
+		length, width = self.size
+		center = np.array(self.location, dtype=float)
+		return [tuple(center + a * length / 2.0 * along + b * width / 2.0 * across) 
+			for a, b in ((-1, -1), (1, -1), (1, 1), (-1, 1))]
+	
+	def getLineProfile(self, pixels, axis=0, step=1.0):
+		'''Profile along the length (axis 0, averaged across the width) or 
+		across the width (axis 1), sampled every step pixels with bilinear 
+		interpolation. Points are distances from the edge of the rectangle.'''
+		along, across = self.getAxes()
+		offsets = []
+		for length in self.size:
+			num = max(int(round(length / step)), 1)
+			offsets.append((np.arange(num) + 0.5) * length / num - length / 2.0)
+		a, b = np.meshgrid(offsets[0], offsets[1], indexing='ij')
+		x = self.location[0] + a * along[0] + b * across[0]
+		y = self.location[1] + a * along[1] + b * across[1]
+		samples = bilinearSample(pixels, x, y)
+		valid = ~np.isnan(samples)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			values = np.where(valid, samples, 0).sum(axis=1 - axis) / valid.sum(axis=1 - axis)
+		points = offsets[axis] + self.size[axis] / 2.0
+		return points, values
+	
+	def getProfileLabel(self, axis=0):
+		return 'distance along (pixel)' if axis == 0 else 'distance across (pixel)'
+	
+	def plotLineProfile(self, pixels, axis=0):
+		fig = plot.figure()
+		pctrender.drawLineProfile(fig, self, pixels, axis)
+		return fig
+
+class VolumeROI(ROI):
+	'''Generic volumetric ROI
+	Coordinates are (x, y, z), where z is the index of the slice in the 
+	volume, and imageshape is the (slice, y, x) shape of the volume (as 
+	Image.volume).
+	'''
+	
+	ndim = 3
+	
+	def __init__(self, name, location, size, imageshape):
+		ROI.__init__(self, name, location, size, imageshape)
+		self.bbox, self.local_mask = self.makeLocalMask()
+		# number of voxels
+		self.area = self.calculateArea()
+	
+	def getBlock(self, volume, xyz=False):
+		'''The bounding box of the ROI from volume: a (slice, y, x) array, an 
+		[x][y][z] array (as from pct.ctload) with xyz, or an Image (from 
+		pct.image), of which only the slices inside the box are read.'''
+		bbox, local_mask = self.getLocalMask()
+		if hasattr(volume, 'slices'):
+			return np.array([volume.slices[i].pixels[bbox[1:]] for i in range(bbox[0].start, bbox[0].stop)]).reshape(local_mask.shape)
+		if xyz:
+			volume = volume.transpose(2, 1, 0)
+		return volume[bbox]
+	
+	def getValues(self, volume, xyz=False):
+		bbox, local_mask = self.getLocalMask()
+		return self.getBlock(volume, xyz)[local_mask]
+	
+	def measure(self, volume, xyz=False):
+		'''Mean and standard deviation over the ROI (see getBlock for volume and xyz).'''
+		values = self.getValues(volume, xyz)
+		return values.mean(), values.std()
+	
+	def plotHistogram(self, volume, bins=100, xyz=False):
+		plot.hist(self.getValues(volume, xyz), histtype='step', bins=bins)
+		plot.xlabel('RSP')
+		plot.title(self.name)
+		plot.show()
+
+class SphereROI(VolumeROI):
+	'''Spherical ROI
+	location: tuple of coordinates of its center (x, y, z)
+	size: radius, in units of voxel_size
+	voxel_size: (x, y, z) voxel dimensions (default is 1 pixel, so that 
+		the radius is in pixels)
+	'''
+	
+	def __init__(self, name, location, size, imageshape, voxel_size=(1.0, 1.0, 1.0)):
+		self.voxel_size = voxel_size
+		VolumeROI.__init__(self, name, location, size, imageshape)
+	
+	def makeLocalMask(self):
+		r = self.size
+		bbox = []
+		offsets = []
+		# axes in (slice, y, x) order
+		for center, voxel, length in zip(self.location[::-1], self.voxel_size[::-1], self.imageshape):
+			extent = r / float(voxel)
+			axis = clippedSlice(int(np.ceil(center - extent)), int(np.floor(center + extent)) + 1, length)
+			bbox.append(axis)
+			offsets.append((np.arange(axis.start, axis.stop) - center) * voxel)
+		dz, dy, dx = offsets
+		mask = (dz[:, np.newaxis, np.newaxis]**2 + dy[np.newaxis, :, np.newaxis]**2 + dx[np.newaxis, np.newaxis, :]**2) <= r**2
+		return tuple(bbox), mask
+
+class CylinderROI(VolumeROI):
+	'''Cylindrical ROI along the slice axis
+	location: tuple of coordinates of its center (x, y)
+	size: radius
+	slice_range: (first, stop) range of slice indices it spans
+	'''
+	
+	def __init__(self, name, location, size, slice_range, imageshape):
+		self.slice_range = slice_range
+		VolumeROI.__init__(self, name, location, size, imageshape)
+	
+	def makeLocalMask(self):
+		x, y = self.location
+		r = self.size
+		slices = clippedSlice(self.slice_range[0], self.slice_range[1], self.imageshape[0])
+		rows = clippedSlice(y - r, y + r + 1, self.imageshape[1])
+		columns = clippedSlice(x - r, x + r + 1, self.imageshape[2])
+		disk = diskMask(x, y, r, rows, columns)
+		return (slices, rows, columns), np.repeat(disk[np.newaxis], slices.stop - slices.start, axis=0)
+	
+	def getOverlayPatch(self, color='red'):
+		return mpl.patches.Circle(self.location, radius=self.size, facecolor='none', edgecolor=color, label=self.name)
+
+class BoxROI(VolumeROI):
+	'''Box shaped ROI
+	location: tuple of coordinates of its corner (x, y, z)
+	size: tuple of dimensions (w, h, d)
+	'''
+	
+	def makeLocalMask(self):
+		bbox = tuple(clippedSlice(start, start + length, limit) 
+			for start, length, limit in zip(self.location[::-1], self.size[::-1], self.imageshape))
+		return bbox, np.ones([s.stop - s.start for s in bbox], bool)
+	
+	def measure(self, volume, xyz=False):
+		block = self.getBlock(volume, xyz)
+		return block.mean(), block.std()
+	
+	def getOverlayPatch(self, color='red'):
+		return mpl.patches.Rectangle(self.location[:2], self.size[0], self.size[1], facecolor='none', edgecolor=color, label=self.name)
+
+def _reduceSegments(values, starts, counts, weights=None):
+	'''Mean, standard deviation, minimum and maximum over consecutive column 
+	segments of values (starting at starts, with lengths counts), for every 
+	row. The mean and standard deviation are weighted by weights (one per 
+	column) if given. Empty segments give NaN.'''
+	shape = (values.shape[0], len(counts))
+	means, sigmas, minimums, maximums = [np.empty(shape) for i in range(4)]
+	for result in (means, sigmas, minimums, maximums):
+		result.fill(np.nan)
+	used = counts > 0
+	if not used.any():
+		return means, sigmas, minimums, maximums
+	
+	# empty segments have no length, so reducing over the used starts only 
+	# still gives the right boundaries
+	starts = starts[used]
+	used_counts = counts[used]
+	if weights is None:
+		means[:, used] = np.add.reduceat(values, starts, axis=1) / used_counts
+		deviations = values - np.repeat(means[:, used], used_counts, axis=1)
+		sigmas[:, used] = np.sqrt(np.add.reduceat(deviations**2, starts, axis=1) / used_counts)
+	else:
+		totals = np.add.reduceat(weights, starts)
+		means[:, used] = np.add.reduceat(values * weights, starts, axis=1) / totals
+		deviations = values - np.repeat(means[:, used], used_counts, axis=1)
+		sigmas[:, used] = np.sqrt(np.add.reduceat(weights * deviations**2, starts, axis=1) / totals)
+	minimums[:, used] = np.minimum.reduceat(values, starts, axis=1)
+	maximums[:, used] = np.maximum.reduceat(values, starts, axis=1)
+	return means, sigmas, minimums, maximums
+
+def measureRegions(regions, images, slicenums=None):
+	'''Measure every region on every slice of one or more images in one pass.
+	regions: list of ROI objects
+	images: an Image (from pct.image), or a list of them (e.g. iterations)
+	slicenums: only measure these slices (default is all slices)
+	
+	Each region is turned into the flat indices of its pixels once, and all 
+	statistics are reduced over those at once for a whole stack of slices.
+	The pixel weights of supersampled regions are used as in ROI.measure.
+	Returns a numpy structured array with one row per region, image and 
+	slice (in that order) and the fields name, iteration, slice, mean, std, 
+	min, max and count (the area of the region, in pixels).
+	'''
+	if not isinstance(images, (list, tuple)):
+		images = [images]
+	if any(region.ndim != 2 for region in regions):
+		raise ValueError('Only 2D regions can be measured on slices')
+	
+	indices = [region.flatIndices() for region in regions]
+	counts = np.array([len(i) for i in indices], dtype=int)
+	starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(int)
+	flat_indices = np.concatenate(indices) if indices else np.zeros(0, int)
+	areas = [region.calculateArea() for region in regions]
+	
+	weights = [region.getPixelWeights() for region in regions]
+	if all(w is None for w in weights):
+		weights = None
+	else:
+		weights = np.concatenate([np.ones(len(i)) if w is None else w for i, w in zip(indices, weights)])
+	
+	results = []
+	for image in images:
+		for region in regions:
+			if tuple(region.imageshape) != tuple(image.shape):
+				raise ValueError('Region %s was made for images of shape %s, not %s' % (region.name, tuple(region.imageshape), tuple(image.shape)))
+		slices = image.slices
+		if slicenums is not None:
+			slices = [slice for slice in slices if slice.num in slicenums]
+		if not slices:
+			continue
+		# slice by slice, so a lazy image only reads the selected slices
+		values = np.empty((len(slices), len(flat_indices)))
+		for s, slice in enumerate(slices):
+			values[s] = slice.pixels.ravel()[flat_indices]
+		stats = _reduceSegments(values, starts, counts, weights)
+		iteration = image.iteration if image.iteration is not None else -1
+		results.append((iteration, [slice.num for slice in slices], stats))
+	
+	rows = []
+	for r, region in enumerate(regions):
+		for iteration, nums, (means, sigmas, minimums, maximums) in results:
+			for s, num in enumerate(nums):
+				rows.append((region.name, iteration, num if num is not None else -1, 
+					means[s, r], sigmas[s, r], minimums[s, r], maximums[s, r], areas[r]))
+	
+	name_length = max([len(region.name) for region in regions] + [1])
+	dtype = [('name', 'S%d' % name_length), ('iteration', int), ('slice', int), 
+		('mean', float), ('std', float), ('min', float), ('max', float), ('count', float)]
+	return np.array(rows, dtype=dtype)
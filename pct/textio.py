@@ -0,0 +1,55 @@
+"""
+Fast text output of numeric arrays.
+
+Values are formatted a block of rows at a time with one string formatting 
+operation, instead of one per row (like np.savetxt) or per value.
+
+================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+# number of values formatted at a time
+block_values = 1 << 16
+
+def writeArray(f, array, precision=6, fmt=None, delimiter=' '):
+    '''
+    Write a 1D or 2D array as text, one row per line (a 1D array is written 
+    as a single column, like np.savetxt).
+    f: filename or open file
+    precision: number of decimal places
+    fmt: format of one value, overrides precision (e.g. '%.18e')
+    '''
+    if not hasattr(f, 'write'):
+        with open(f, 'w') as f:
+            return writeArray(f, array, precision, fmt, delimiter)
+    
+    array = np.asarray(array)
+    if array.ndim == 1:
+        array = array[:, np.newaxis]
+    elif array.ndim != 2:
+        raise ValueError('Only 1D and 2D arrays can be written as text')
+    if fmt is None:
+        fmt = '%%.%df' % precision
+    
+    num_rows, num_columns = array.shape
+    row_format = delimiter.join([fmt] * num_columns) + '\n'
+    block_rows = max(block_values // max(num_columns, 1), 1)
+    for start in xrange(0, num_rows, block_rows):
+        block = array[start:start + block_rows]
+        f.write((row_format * len(block)) % tuple(block.ravel().tolist()))
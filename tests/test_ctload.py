@@ -0,0 +1,76 @@
+"""
+HU to RSP conversion of CT images, checked against the original pixel by
+pixel conversion (ctload.convertToRSP). Run from the top of the repository
+with:
+
+    python -m unittest discover tests
+
+=================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+import numpy as np
+
+from pct import ctload
+
+def convertReference(points, hu_value):
+    '''convertToRSP for any calibration curve.'''
+    if hu_value <= points[0][0]:
+        return 0
+    for i in range(len(points) - 1):
+        if hu_value < points[i + 1][0]:
+            slope = (points[i + 1][1] - points[i][1]) / (points[i + 1][0] - points[i][0])
+            return slope * (hu_value - points[i][0]) + points[i][1]
+    return 0
+
+class RSPCalibrationTest(unittest.TestCase):
+
+    def assertConverts(self, calibration, hu_values, reference):
+        expected = np.array([reference(value) for value in hu_values.ravel()], dtype=float)
+        result = calibration.convert(hu_values)
+        self.assertEqual(result.dtype, np.float64)
+        self.assertEqual(result.shape, hu_values.shape)
+        np.testing.assert_array_equal(result.ravel(), expected)
+
+    def testIntegers(self):
+        # the whole range of the look-up table and past both of its ends
+        hu_values = np.arange(-100, 4200, dtype=np.int16).reshape(43, 100)
+        self.assertConverts(ctload.RSPCalibration(), hu_values, ctload.convertToRSP)
+        self.assertConverts(ctload.RSPCalibration(), np.array([0, 1, 4094, 4095, 4096, 65535], dtype=np.uint16), ctload.convertToRSP)
+
+    def testFloats(self):
+        ends = [-1.0, -1e-9, 0.0, 1e-9, 0.5, 799.9, 800.0, 800.1, 1049.5, 4094.999, 4095.0, 4095.5, 1e6]
+        hu_values = np.concatenate([ends, np.random.RandomState(1).uniform(-50, 4150, 1000)])
+        self.assertConverts(ctload.RSPCalibration(), hu_values, ctload.convertToRSP)
+
+    def testCustomCurve(self):
+        # ends which are not integers, so the look-up table starts and
+        # stops between them
+        points = ((-10.5, 0.1), (100.25, 0.9), (2000.75, 1.7))
+        calibration = ctload.RSPCalibration(points)
+        reference = lambda value: convertReference(points, value)
+        self.assertConverts(calibration, np.arange(-20, 2010), reference)
+        self.assertConverts(calibration, np.array([-10.5, -10.25, 100.25, 2000.5, 2000.75, 2001.0]), reference)
+
+    def testInvalidCurves(self):
+        self.assertRaises(ValueError, ctload.RSPCalibration, ((0.0, 0.0),))
+        self.assertRaises(ValueError, ctload.RSPCalibration, ((0.0, 0.0), (0.0, 1.0)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Round trips between the pCT data formats, on synthetic projection files.
+
+Archived scans have to stay readable and convertible, so every conversion
+that is meant to be lossless is checked to give back the same bytes. Run
+from the top of the repository with:
+
+    python -m unittest discover tests
+
+=================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from pct import dataconvert, instrument
+from benchmarks import synthetic
+
+num_events = 2500
+# small enough that the files have several chunks, the last one partial
+chunk_size = 1000
+
+def readBytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def writeOldBinaryReference(filename, data):
+    '''The original event by event .dat writer, to compare against.'''
+    u_coords = []
+    for i in range(4):
+        u_set = list(set(np.asarray(data.u[i]).tolist()))
+        if len(u_set) == 1:
+            u_set *= 2
+        u_coords.extend(u_set)
+    with open(filename, 'wb') as f:
+        for i in range(data.num_events):
+            for n in range(4):
+                f.write(struct.pack('f', data.v[n][i]))
+            for n in range(4):
+                f.write(struct.pack('f', data.t[n][i]))
+            for n in range(4):
+                f.write(struct.pack('B', u_coords.index(data.u[n][i])))
+            f.write(struct.pack('ffI', data.wepl[i], data.projection_angle, 0))
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = instrument.current()
+        instrument.configure(verbosity=0)
+        self.workdir = tempfile.mkdtemp(prefix='pypct-test-')
+        self.original = self.path('original', 'projection.bin')
+        synthetic.makeProjectionFile(self.original, num_events, angle=12.0, seed=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+        instrument.configure(self.previous.verbosity, self.previous.progress_callback, self.previous.stream)
+
+    def path(self, dirname, filename):
+        '''A file name in its own directory (each .dat file has a scan.cfg next to it).'''
+        dirname = os.path.join(self.workdir, dirname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return os.path.join(dirname, filename)
+
+    def convert(self, source, filename, version=None):
+        '''Convert source to filename: .dat, or .bin with version.'''
+        data = dataconvert.readFile(source)
+        if version is None:
+            return dataconvert.writeOldBinaryFile(filename, data, chunk_size=chunk_size)
+        return dataconvert.writeNewBinaryFile(filename, data, version, chunk_size=chunk_size)
+
+    def testVersion0(self):
+        filename = self.path('v0', 'projection.bin')
+        self.assertEqual(self.convert(self.original, filename, 0), num_events)
+        self.assertEqual(readBytes(filename), readBytes(self.original))
+
+    def testVersion1(self):
+        v1 = self.path('v1', 'projection.bin')
+        v0 = self.path('v0', 'projection.bin')
+        self.convert(self.original, v1, 1)
+        self.convert(v1, v0, 0)
+        self.assertEqual(readBytes(v0), readBytes(self.original))
+
+        data = dataconvert.readFile(v1)
+        self.assertEqual(data.num_events, num_events)
+        self.assertEqual(list(data.chunk_index['num_events']), [1000, 1000, 500])
+        self.assertTrue(np.all(data.chunk_index['wepl_min'] <= data.chunk_index['wepl_max']))
+
+    def testVersion1Slicing(self):
+        v1 = self.path('v1', 'projection.bin')
+        self.convert(self.original, v1, 1)
+        column = dataconvert.readFile(v1).wepl
+        expected = np.asarray(dataconvert.readFile(self.original).wepl)
+        for key in (slice(None), slice(999, 1001), slice(5, 2400, 7), slice(None, None, -1),
+                    slice(2100, 10, -3), slice(-1, -2000, -1000), slice(10, 20, -1)):
+            np.testing.assert_array_equal(column[key], expected[key])
+        self.assertEqual(column[-1], expected[-1])
+
+    def testOldBinary(self):
+        data = dataconvert.readFile(self.original)
+        reference = self.path('reference', 'projection.dat')
+        writeOldBinaryReference(reference, data)
+
+        filename = self.path('dat', 'projection.dat')
+        self.assertEqual(self.convert(self.original, filename), num_events)
+        self.assertEqual(readBytes(filename), readBytes(reference))
+
+    def testOldBinaryThroughVersion1(self):
+        dat = self.path('dat', 'projection.dat')
+        v1 = self.path('v1', 'projection.bin')
+        dat_again = self.path('dat_again', 'projection.dat')
+        self.convert(self.original, dat)
+        self.convert(dat, v1, 1)
+        self.convert(v1, dat_again)
+        self.assertEqual(readBytes(dat_again), readBytes(dat))
+        self.assertEqual(readBytes(os.path.join(os.path.dirname(dat_again), 'scan.cfg')),
+                         readBytes(os.path.join(os.path.dirname(dat), 'scan.cfg')))
+
+    def testSelectionCount(self):
+        # the events kept by the cut are only counted as they are written,
+        # so the header of version 1 is filled in at the end
+        expected = np.count_nonzero(np.asarray(dataconvert.readFile(self.original).wepl) <= 100)
+        for version in (0, 1):
+            filename = self.path('v%d' % version, 'projection.bin')
+            selection = dataconvert.EventSelection(wepl=(0, 100))
+            data = dataconvert.readFile(self.original)
+            self.assertEqual(dataconvert.writeNewBinaryFile(filename, data, version, chunk_size=chunk_size, selection=selection), expected)
+            data = dataconvert.readFile(filename)
+            self.assertEqual(data.num_events, expected)
+            self.assertTrue(np.asarray(data.wepl).max() <= 100)
+
+if __name__ == '__main__':
+    unittest.main()
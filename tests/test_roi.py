@@ -0,0 +1,135 @@
+"""
+Masks and radial profiles of the regions of interest, checked against the
+original pixel by pixel loops, including regions clipped by the edges of the
+image. Run from the top of the repository with:
+
+    python -m unittest discover tests
+
+=================
+
+Copyright (C) 2013 Ford Hurley, ford.hurley@gmail.com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+import numpy as np
+
+from pct import roi
+
+# the original loops clip rows to imageshape[1] and columns to
+# imageshape[0], and fail on non-square images when that is past the end of
+# the mask; here both limits are applied
+def inside(row, column, imageshape):
+    return (0 <= row < min(imageshape[1], imageshape[0]) and
+            0 <= column < min(imageshape[0], imageshape[1]))
+
+def circleMaskReference(location, r, imageshape):
+    '''The original CircleROI.makeArrayMask.'''
+    x, y = location
+    mask = np.zeros(imageshape, bool)
+    for row in range(y - r, y + r + 1):
+        for column in range(x - r, x + r + 1):
+            if inside(row, column, imageshape):
+                if (row - y)**2 + (column - x)**2 <= r**2:
+                    mask[row][column] = True
+    return mask
+
+def rectangleMaskReference(location, size, imageshape):
+    '''The original RectangleROI.makeArrayMask.'''
+    x, y = location
+    w, h = size
+    mask = np.zeros(imageshape, bool)
+    for row in range(y, y + h):
+        for column in range(x, x + w):
+            if inside(row, column, imageshape):
+                mask[row][column] = True
+    return mask
+
+def radialProfileReference(region, pixels):
+    '''
+    The original CircleROI.getRadialProfile, with distances measured from
+    (x, y) to (column, row); the original compared rows to x. Returns the
+    mean and standard deviation of each ring (NaN for empty rings).
+    '''
+    rows, columns = np.nonzero(region.mask)
+    x, y = region.location
+    means, sigmas = [], []
+    for r in range(region.size):
+        values_at_r = []
+        min_dist_sq = max(r - 1, 0)**2
+        max_dist_sq = r**2
+        for row, column in zip(rows, columns):
+            dist_sq = (column - x)**2 + (row - y)**2
+            if dist_sq <= max_dist_sq and dist_sq >= min_dist_sq:
+                values_at_r.append(pixels[row][column])
+        means.append(np.mean(values_at_r) if values_at_r else np.nan)
+        sigmas.append(np.std(values_at_r) if values_at_r else np.nan)
+    return np.array(means), np.array(sigmas)
+
+class MaskTest(unittest.TestCase):
+
+    shapes = ((40, 40), (30, 50), (50, 30))
+
+    def testCircle(self):
+        for imageshape in self.shapes:
+            for location in ((20, 15), (0, 0), (2, 38), (39, 25), (-3, 10), (45, 45)):
+                for r in (0, 1, 3, 7, 30):
+                    region = roi.CircleROI('c', location, r, imageshape)
+                    expected = circleMaskReference(location, r, imageshape)
+                    np.testing.assert_array_equal(region.mask, expected)
+                    self.assertEqual(region.area, expected.sum())
+
+    def testRectangle(self):
+        for imageshape in self.shapes:
+            for location in ((5, 8), (0, 0), (-4, 30), (35, -2), (60, 5)):
+                for size in ((1, 1), (10, 3), (3, 10), (60, 60)):
+                    region = roi.RectangleROI('r', location, size, imageshape)
+                    expected = rectangleMaskReference(location, size, imageshape)
+                    np.testing.assert_array_equal(region.mask, expected)
+                    self.assertEqual(region.area, expected.sum())
+
+    def testRectangleMeasure(self):
+        pixels = np.random.RandomState(2).normal(1.0, 0.1, (40, 40))
+        region = roi.RectangleROI('r', (30, -5), (20, 15), pixels.shape)
+        expected = pixels[rectangleMaskReference((30, -5), (20, 15), pixels.shape)]
+        np.testing.assert_allclose(region.measure(pixels), (expected.mean(), expected.std()))
+
+class RadialProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stack = np.random.RandomState(4).normal(1.0, 0.1, (3, 40, 50))
+
+    def testProfile(self):
+        # centers off the diagonal, and clipped by the edges
+        for location, r in (((20, 12), 9), ((30, 25), 12), ((3, 37), 8), ((47, 2), 6)):
+            region = roi.CircleROI('c', location, r, (40, 50))
+            pixels = self.stack[0]
+            means, sigmas = radialProfileReference(region, pixels)
+            points, values = region.getRadialProfile(pixels)
+            self.assertEqual(list(points), range(r))
+            np.testing.assert_allclose(values, means)
+            points, values, deviations, counts = region.getRadialStatistics(pixels)
+            np.testing.assert_allclose(deviations, sigmas, atol=1e-12)
+
+    def testStack(self):
+        region = roi.CircleROI('c', (18, 22), 10, (40, 50))
+        points, values = region.getRadialProfile(self.stack)
+        self.assertEqual(values.shape, (len(self.stack), 10))
+        for pixels, slice_values in zip(self.stack, values):
+            np.testing.assert_allclose(slice_values, radialProfileReference(region, pixels)[0])
+
+if __name__ == '__main__':
+    unittest.main()